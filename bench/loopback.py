@@ -0,0 +1,187 @@
+# In-process stand-in for the subset of python-cdds used by dstore.
+#
+# Samples written on a partition are copied (as DDS would serialize them) and delivered by a
+# single bus thread to the readers of the same topic whose partition expression matches, so
+# the stores of a process can talk to each other without a DDS installation or a network.
+#
+# USAGE:
+#     import loopback
+#     loopback.install()   # before importing dstore
+#     import dstore
+
+import copy
+import fnmatch
+import queue
+import sys
+import threading
+import time
+
+
+__all__ = ['DDS_State', 'DDS_Event', 'DDS_ANY_SAMPLE_STATE', 'DDS_ANY_STATE',
+           'DDS_NOT_ALIVE_NO_WRITERS_INSTANCE_STATE', 'DDS_NOT_ALIVE_DISPOSED_INSTANCE_STATE',
+           'TopicType', 'Runtime', 'Participant', 'FlexyTopic', 'Publisher', 'Subscriber',
+           'FlexyWriter', 'FlexyReader']
+
+DDS_State = 'state'
+DDS_Event = 'event'
+
+DDS_ANY_SAMPLE_STATE = 0x01
+DDS_ANY_STATE = 0x02
+DDS_NOT_ALIVE_NO_WRITERS_INSTANCE_STATE = 0x04
+DDS_NOT_ALIVE_DISPOSED_INSTANCE_STATE = 0x08
+
+
+class TopicType(object):
+    pass
+
+
+class KeySample(object):
+    """The sample delivered for a disposed instance, only the key is valid"""
+
+    def __init__(self, key):
+        self.key = key
+
+
+class SampleInfo(object):
+    def __init__(self, valid_data, disposed):
+        self.valid_data = valid_data
+        self.disposed = disposed
+        self.source_timestamp = time.time()
+
+    def is_disposed_instance(self):
+        return self.disposed
+
+
+class Bus(object):
+    """Delivers the samples written in the process, one at a time, like a DDS listener thread"""
+
+    def __init__(self):
+        self.readers = []
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.delivered = 0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def attach(self, reader):
+        with self.lock:
+            self.readers = self.readers + [reader]
+
+    def publish(self, writer, sample, disposed):
+        rs = [r for r in self.readers if r.topic.name == writer.topic.name
+              and fnmatch.fnmatch(writer.partition, r.partition)]
+        for r in rs:
+            if disposed:
+                s = KeySample(sample.gen_key())
+            else:
+                s = copy.deepcopy(sample)
+            self.queue.put((r, s, SampleInfo(not disposed, disposed)))
+
+    def drain(self, timeout=None):
+        """Waits until all the samples written so far have been delivered
+
+        :param timeout: the maximum time to wait
+        :return: True if the bus is idle
+        """
+        t_end = None if timeout is None else time.time() + timeout
+        while self.queue.unfinished_tasks > 0:
+            if t_end is not None and time.time() > t_end:
+                return False
+            time.sleep(0.001)
+        return True
+
+    def run(self):
+        while True:
+            (r, s, i) = self.queue.get()
+            try:
+                r.deliver(s, i)
+            except Exception as e:
+                print('Loopback delivery failed: {}'.format(e))
+            finally:
+                self.delivered = self.delivered + 1
+                self.queue.task_done()
+
+
+bus = Bus()
+
+
+class Runtime(object):
+    @staticmethod
+    def get_runtime():
+        return Runtime()
+
+    def close(self):
+        pass
+
+
+class Participant(object):
+    def __init__(self, domain_id):
+        self.domain_id = domain_id
+
+
+class FlexyTopic(object):
+    def __init__(self, dp, name):
+        self.dp = dp
+        self.name = name
+
+
+class Publisher(object):
+    def __init__(self, dp, partition):
+        self.dp = dp
+        self.partition_name = partition
+
+    @staticmethod
+    def partition(p):
+        return p
+
+
+class Subscriber(Publisher):
+    pass
+
+
+class FlexyWriter(object):
+    def __init__(self, pub, topic, state):
+        self.topic = topic
+        self.partition = pub.partition_name
+
+    def write(self, s):
+        bus.publish(self, s, False)
+
+    def dispose_instance(self, s):
+        bus.publish(self, s, True)
+
+
+class FlexyReader(object):
+    def __init__(self, sub, topic, listener, state):
+        self.topic = topic
+        self.partition = sub.partition_name
+        self.listener = listener
+        self.liveliness_listener = None
+        self.lock = threading.Lock()
+        self.pending = []
+        bus.attach(self)
+
+    def deliver(self, s, i):
+        with self.lock:
+            self.pending.append((s, i))
+        if self.listener is not None:
+            self.listener(self)
+
+    def take(self, mask=None):
+        with self.lock:
+            xs = self.pending
+            self.pending = []
+        return xs
+
+    def read(self, mask=None):
+        with self.lock:
+            return list(self.pending)
+
+    def on_liveliness_changed(self, fn):
+        self.liveliness_listener = fn
+
+
+def install():
+    """Registers this module as cdds, it must be called before dstore is imported"""
+    sys.modules['cdds'] = sys.modules[__name__]
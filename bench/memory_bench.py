@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+# Memory used by the tables of a store: dictionary of (value, version) tuples and CompactTable,
+# on their own and within a whole Store, whose key index and bookkeeping are then accounted.
+#
+# The keys are shaped like the ones of fog05, e.g. afos://0/<node>/runtime/<plugin>/entity/<uuid>/status,
+# the values are short strings shared by all the entries so that only the cost of the table
+# is measured. The results are printed as JSON.
+#
+# USAGE:
+#     python3 bench/memory_bench.py [-n keys[,keys...]]
+
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# the dstore package imports cdds
+import loopback
+loopback.install()
+
+from dstore import Store
+from dstore.logger import DLogger
+from dstore.table import CompactTable
+
+# The debug log of the stores would be the dominant cost
+DLogger.enabled = False
+
+
+LEAVES = ['info', 'status', 'configuration', 'runtime', 'network', 'resources', 'plugins', 'descriptor']
+
+
+def gen_keys(n):
+    # each entity has the same 8 leaves, the entities are spread on the nodes and the plugins
+    nodes = max(n // 100000, 1)
+    for i in range(n):
+        e = i // len(LEAVES)
+        yield 'afos://0/{:032x}/runtime/{:08x}/entity/{:032x}/{}'.format(
+            e % nodes, (e // nodes) % 16, e, LEAVES[i % len(LEAVES)])
+
+
+def measure(table, n):
+    value = '{"status": "run"}'
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    t = time.time()
+    xs = table()
+    for (i, k) in enumerate(gen_keys(n)):
+        xs[k] = (value, i)
+    elapsed = time.time() - t
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    keys = list(gen_keys(min(n, 100000)))
+    t = time.time()
+    for k in keys:
+        xs.get(k)
+    lookups = len(keys) / (time.time() - t)
+    del xs
+    return {'bytes': size, 'bytes/key': size / n, 'insert/s': n / elapsed, 'get/s': lookups}
+
+
+def measure_store(compact, n):
+    # all the keys are under the home of the store, they are added as the remote updates are
+    value = '{"status": "run"}'
+    s = Store('bench', 'afos://0', 'afos://0', 1024, compact=compact)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    t = time.time()
+    for (i, k) in enumerate(gen_keys(n)):
+        s.update_value(k, value, i)
+    elapsed = time.time() - t
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    t = time.time()
+    pages = 0
+    page = s.scan('afos://0/', None, 1000)
+    while len(page) == 1000 and pages < 100:
+        page = s.scan('afos://0/', page[-1][0], 1000)
+        pages += 1
+    scans = (pages + 1) / (time.time() - t)
+    s.close()
+    return {'bytes': size, 'bytes/key': size / n, 'insert/s': n / elapsed, 'scan pages/s': scans}
+
+
+def run(sizes):
+    report = {'python': sys.version.split(' ')[0], 'results': []}
+    for n in sizes:
+        d = measure(dict, n)
+        c = measure(CompactTable, n)
+        sd = measure_store(False, n)
+        sc = measure_store(True, n)
+        report['results'].append({'keys': n, 'dict': d, 'compact': c, 'ratio': c['bytes'] / d['bytes'],
+                                  'store': sd, 'compact store': sc, 'store ratio': sc['bytes'] / sd['bytes']})
+    return report
+
+
+if __name__ == '__main__':
+    sizes = [10000, 100000, 1000000]
+    if len(sys.argv) > 2 and sys.argv[1] == '-n':
+        sizes = [int(x) for x in sys.argv[2].split(',')]
+    print(json.dumps(run(sizes), indent=2))
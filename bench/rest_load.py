@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# Load test for the REST store service.
+#
+# Creates a store on the service and then runs the given number of concurrent clients,
+# each one issuing puts and then gets on its own keys over a persistent HTTP connection.
+# The throughput and the latency percentiles of each operation are printed as JSON.
+#
+# USAGE:
+#     python3 bench/rest_load.py [-H host] [-p port] [-c clients] [-n requests-per-client]
+
+import http.client
+import json
+import sys
+import threading
+import time
+import urllib.parse
+
+
+def percentile(xs, p):
+    if len(xs) == 0:
+        return None
+    xs = sorted(xs)
+    return xs[min(int(len(xs) * p), len(xs) - 1)]
+
+
+def request(conn, method, url, form=None):
+    headers = {}
+    body = None
+    if form is not None:
+        body = urllib.parse.urlencode(form)
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    conn.request(method, url, body, headers)
+    r = conn.getresponse()
+    r.read()
+    return r.status
+
+
+def client(host, port, sid, cid, n, latencies):
+    conn = http.client.HTTPConnection(host, port)
+    keys = ['bench/{}/{}/k{}'.format(sid, cid, i) for i in range(n)]
+    for k in keys:
+        t = time.time()
+        request(conn, 'PUT', '/put/{}/{}'.format(sid, k), {'value': '{"v": 1}'})
+        latencies['put'].append(time.time() - t)
+    for k in keys:
+        t = time.time()
+        request(conn, 'GET', '/get/{}/{}'.format(sid, k))
+        latencies['get'].append(time.time() - t)
+    conn.close()
+
+
+def run(host, port, clients, n):
+    sid = 'bench-{}'.format(int(time.time()))
+    conn = http.client.HTTPConnection(host, port)
+    request(conn, 'POST', '/create/{}'.format(sid), {'root': 'bench', 'home': 'bench/{}'.format(sid), 'size': 1024})
+    conn.close()
+
+    latencies = {'put': [], 'get': []}
+    ths = [threading.Thread(target=client, args=(host, port, sid, i, n, latencies)) for i in range(clients)]
+    t = time.time()
+    for th in ths:
+        th.start()
+    for th in ths:
+        th.join()
+    elapsed = time.time() - t
+
+    report = {'clients': clients, 'requests': clients * n * 2, 'elapsed': elapsed,
+              'req/s': clients * n * 2 / elapsed}
+    for op, xs in latencies.items():
+        report[op] = {'p50': percentile(xs, 0.50), 'p99': percentile(xs, 0.99),
+                      'req/s': len(xs) / sum(xs) * clients if len(xs) > 0 else None}
+    return report
+
+
+if __name__ == '__main__':
+    host = 'localhost'
+    port = 5000
+    clients = 8
+    n = 1000
+    idx = 1
+    while idx < len(sys.argv) - 1:
+        if sys.argv[idx] == '-H':
+            host = sys.argv[idx + 1]
+        elif sys.argv[idx] == '-p':
+            port = int(sys.argv[idx + 1])
+        elif sys.argv[idx] == '-c':
+            clients = int(sys.argv[idx + 1])
+        elif sys.argv[idx] == '-n':
+            n = int(sys.argv[idx + 1])
+        idx = idx + 2
+
+    print(json.dumps(run(host, port, clients, n), indent=2))
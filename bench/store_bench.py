@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+
+# Benchmarks of the store hot paths and of the distributed resolution.
+#
+# The stores run in a single process over the loopback transport (see loopback.py), thus no
+# DDS installation nor network is needed. The results are printed as JSON so that they can be
+# saved and compared across commits, e.g.
+#
+#     python3 bench/store_bench.py -s 1000,10000,100000 -o before.json
+#
+# USAGE:
+#     python3 bench/store_bench.py [-s sizes] [-P peers] [-r rounds] [-b benchmarks] [-o file]
+#
+# where benchmarks is a comma separated list of: ops, resolve, rest, web
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import loopback
+loopback.install()
+
+from dstore import Store, StoreHost
+from dstore.logger import DLogger
+
+# The debug log of the stores would be the dominant cost
+DLogger.enabled = False
+
+
+def percentile(xs, p):
+    if len(xs) == 0:
+        return None
+    xs = sorted(xs)
+    return xs[min(int(len(xs) * p), len(xs) - 1)]
+
+
+def rate(n, elapsed):
+    return n / elapsed if elapsed > 0 else None
+
+
+def latencies(xs):
+    return {'p50': percentile(xs, 0.50), 'p99': percentile(xs, 0.99), 'max': max(xs) if len(xs) > 0 else None}
+
+
+def bench_ops(n):
+    """put/get/getAll/dput/notify_observers rates on a store holding n keys"""
+    root = 'bench'
+    s = Store('ops-{}'.format(n), root, '{}/ops'.format(root), n + 1)
+    keys = ['{}/ops/g{}/k{}'.format(root, i % 100, i) for i in range(n)]
+    report = {'keys': n}
+
+    t = time.time()
+    for k in keys:
+        s.put(k, '{"v": 0}')
+    report['put/s'] = rate(n, time.time() - t)
+    loopback.bus.drain()
+
+    t = time.time()
+    for k in keys:
+        s.get(k)
+    report['get/s'] = rate(n, time.time() - t)
+
+    t = time.time()
+    xs = s.getAll('{}/ops/g0/*'.format(root))
+    report['getAll'] = {'matches': len(xs), 'seconds': time.time() - t}
+
+    m = min(n, 10000)
+    t = time.time()
+    for k in keys[:m]:
+        s.dput('{}#v=1'.format(k))
+    report['dput/s'] = rate(m, time.time() - t)
+    loopback.bus.drain()
+
+    notified = [0]
+
+    def action(key, value, version):
+        notified[0] += 1
+
+    for i in range(10):
+        s.observe('{}/ops/g{}/*'.format(root, i), action)
+    t = time.time()
+    for k in keys[:m]:
+        s.notify_observers(k, '{"v": 2}', 2)
+    report['notify/s'] = rate(m, time.time() - t)
+    report['notified'] = notified[0]
+
+    loopback.bus.drain()
+    s.close()
+    return report
+
+
+def bench_resolve(npeers, rounds):
+    """resolve/resolveAll latencies of a store with npeers simulated peers"""
+    root = 'resolve{}'.format(npeers)
+    host = StoreHost()
+    peers = [host.create('p{}'.format(i), root, '{}/p{}'.format(root, i), 1024) for i in range(npeers)]
+    for (i, p) in enumerate(peers):
+        p.put('{}/p{}/k'.format(root, i), '{}'.format(i))
+    s = host.create('client', root, '{}/client'.format(root), 1024)
+    t = time.time()
+    s.wait_ready(30, npeers)
+    report = {'peers': npeers, 'discovery': time.time() - t, 'discovered': len(s.discovered_stores)}
+    loopback.bus.drain()
+
+    xs = []
+    found = 0
+    for i in range(rounds):
+        t = time.time()
+        v = s.resolve('{}/p{}/k'.format(root, i % npeers))
+        xs.append(time.time() - t)
+        if v is not None:
+            found += 1
+    report['resolve'] = latencies(xs)
+    report['resolve']['found'] = found
+
+    xs = []
+    for i in range(rounds):
+        t = time.time()
+        vs = s.resolveAll('{}/*'.format(root))
+        xs.append(time.time() - t)
+    report['resolveAll'] = latencies(xs)
+    report['resolveAll']['values'] = len(vs)
+
+    host.close_all()
+    loopback.bus.drain()
+    return report
+
+
+def bench_rest(n):
+    """Request rates of the REST service, through the Flask test client"""
+    from dstore import RestStore
+    rs = RestStore()
+    c = rs.app.test_client()
+    c.post('/create/rest', data={'root': 'rest', 'home': 'rest/h', 'size': n + 1})
+    keys = ['rest/h/k{}'.format(i) for i in range(n)]
+    report = {'requests': n}
+
+    t = time.time()
+    for k in keys:
+        c.put('/put/rest/{}'.format(k), data={'value': '{"v": 1}'})
+    report['put/s'] = rate(n, time.time() - t)
+
+    t = time.time()
+    for k in keys:
+        c.get('/get/rest/{}'.format(k))
+    report['get/s'] = rate(n, time.time() - t)
+
+    rs.host.close_all()
+    loopback.bus.drain()
+    return report
+
+
+def bench_web(n, port=9779):
+    """Request rates of the WebSocket service, with the text and the framed protocols"""
+    import asyncio
+    import websockets
+    from dstore import WebStore
+
+    ws = WebStore(port)
+
+    def serve():
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        ws.start()
+
+    th = threading.Thread(target=serve)
+    th.daemon = True
+    th.start()
+    time.sleep(0.5)
+
+    @asyncio.coroutine
+    def client():
+        report = {'requests': n}
+        websocket = yield from websockets.connect('ws://localhost:{}/bench'.format(port))
+        yield from websocket.send('create web web web/h {}'.format(n + 1))
+        yield from websocket.recv()
+
+        t = time.time()
+        for i in range(n):
+            yield from websocket.send('put web web/h/k{} {}'.format(i, i))
+            yield from websocket.recv()
+        report['put/s'] = rate(n, time.time() - t)
+
+        t = time.time()
+        for i in range(n):
+            yield from websocket.send('get web web/h/k{}'.format(i))
+            yield from websocket.recv()
+        report['get/s'] = rate(n, time.time() - t)
+
+        # Pipelined requests on the framed protocol
+        yield from websocket.send('proto json')
+        yield from websocket.recv()
+        t = time.time()
+        for i in range(n):
+            yield from websocket.send(json.dumps({'id': i, 'cmd': 'get', 'sid': 'web', 'key': 'web/h/k{}'.format(i)}))
+        for i in range(n):
+            yield from websocket.recv()
+        report['pipelined get/s'] = rate(n, time.time() - t)
+        yield from websocket.close()
+        return report
+
+    report = asyncio.new_event_loop().run_until_complete(client())
+    ws.stop()
+    loopback.bus.drain()
+    return report
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def run(sizes, peers, rounds, benchmarks):
+    report = {'revision': revision(), 'python': platform.python_version(), 'time': time.time()}
+    if 'ops' in benchmarks:
+        report['ops'] = [bench_ops(n) for n in sizes]
+    if 'resolve' in benchmarks:
+        report['resolve'] = [bench_resolve(p, rounds) for p in peers]
+    for (name, fn) in [('rest', bench_rest), ('web', bench_web)]:
+        if name in benchmarks:
+            try:
+                report[name] = fn(min(sizes))
+            except Exception as e:
+                report[name] = {'error': str(e)}
+    return report
+
+
+if __name__ == '__main__':
+    sizes = [1000, 10000, 100000]
+    peers = [1, 10, 100]
+    rounds = 50
+    benchmarks = ['ops', 'resolve', 'rest', 'web']
+    output = None
+    idx = 1
+    while idx < len(sys.argv) - 1:
+        if sys.argv[idx] == '-s':
+            sizes = [int(x) for x in sys.argv[idx + 1].split(',')]
+        elif sys.argv[idx] == '-P':
+            peers = [int(x) for x in sys.argv[idx + 1].split(',')]
+        elif sys.argv[idx] == '-r':
+            rounds = int(sys.argv[idx + 1])
+        elif sys.argv[idx] == '-b':
+            benchmarks = sys.argv[idx + 1].split(',')
+        elif sys.argv[idx] == '-o':
+            output = sys.argv[idx + 1]
+        idx = idx + 2
+
+    r = json.dumps(run(sizes, peers, rounds, benchmarks), indent=2)
+    if output is not None:
+        with open(output, 'w') as f:
+            f.write(r)
+    print(r)
@@ -1,5 +1,4 @@
 from .store import Store
+from .host import StoreHost
 from .web_store import WebStore
 from .rest_store import RestStore
-
-
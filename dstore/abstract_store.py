@@ -121,7 +121,13 @@ class AbstractStore(object):
         '''
         raise NotImplementedError
 
-    def getAll(self, uri):
+    def get_with_version(self, uri, consistency, min_version=None):
+        '''
+        :return: (value, version)
+        '''
+        raise NotImplementedError
+
+    def getAll(self, uri, where=None, select=None):
         '''
                 :return: [(uri,value)]
         '''
@@ -138,6 +144,12 @@ class AbstractStore(object):
         '''
         raise NotImplementedError
 
+    def unobserve(self, uri, action):
+        '''
+        removes an action registered with observe
+        '''
+        raise NotImplementedError
+
     def iterate(self):
         '''
         iterate into local cache
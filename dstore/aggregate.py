@@ -0,0 +1,237 @@
+import fnmatch
+import heapq
+import json
+import threading
+from .query import Query, get_path, decode_json
+
+# Aggregates of the values of the keys matching a pattern, updated as the values change.
+#
+# Each reducer turns a value into a contribution, or None when the value does not take part
+# in the aggregate, and keeps the result up to date as contributions are added and removed,
+# thus reading an aggregate does not touch the values.
+
+
+def json_value(value):
+    try:
+        return decode_json(value)
+    except ValueError:
+        return None
+
+
+def number(x):
+    if isinstance(x, bool) or not isinstance(x, (int, float)):
+        return None
+    return x
+
+
+class Count(object):
+    """The number of keys"""
+
+    name = 'count'
+
+    def __init__(self):
+        self.count = 0
+
+    def extract(self, value):
+        return 1
+
+    def add(self, c):
+        self.count += 1
+
+    def remove(self, c):
+        self.count -= 1
+
+    def result(self):
+        return self.count
+
+
+class GroupBy(object):
+    """The number of keys for each value of a field"""
+
+    name = 'group'
+
+    def __init__(self, path):
+        self.path = path
+        self.groups = {}
+
+    def extract(self, value):
+        (found, x) = get_path(json_value(value), self.path)
+        if not found:
+            return None
+        if isinstance(x, (dict, list)):
+            return json.dumps(x, sort_keys=True)
+        return x
+
+    def add(self, c):
+        self.groups[c] = self.groups.get(c, 0) + 1
+
+    def remove(self, c):
+        n = self.groups.get(c, 0) - 1
+        if n > 0:
+            self.groups[c] = n
+        else:
+            self.groups.pop(c, None)
+
+    def result(self):
+        return dict(self.groups)
+
+
+class Sum(object):
+    """The sum of a numeric field"""
+
+    name = 'sum'
+
+    def __init__(self, path):
+        self.path = path
+        self.total = 0
+
+    def extract(self, value):
+        (_, x) = get_path(json_value(value), self.path)
+        return number(x)
+
+    def add(self, c):
+        self.total += c
+
+    def remove(self, c):
+        self.total -= c
+
+    def result(self):
+        return self.total
+
+
+class Min(object):
+    """The minimum of a numeric field
+
+    The distinct contributions are kept in a heap and counted, the ones whose count drops
+    to zero are removed when they reach the top, thus updates cost O(log n) and reads O(1)
+    amortized. The heap is rebuilt when the removed contributions outnumber the live ones,
+    so that its size stays bounded by the number of keys.
+    """
+
+    name = 'min'
+    sign = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.heap = []
+        self.in_heap = set()
+        self.counts = {}
+
+    def extract(self, value):
+        (_, x) = get_path(json_value(value), self.path)
+        return number(x)
+
+    def add(self, c):
+        self.counts[c] = self.counts.get(c, 0) + 1
+        if c not in self.in_heap:
+            self.in_heap.add(c)
+            heapq.heappush(self.heap, self.sign * c)
+
+    def remove(self, c):
+        n = self.counts.get(c, 0) - 1
+        if n > 0:
+            self.counts[c] = n
+        else:
+            self.counts.pop(c, None)
+            if len(self.heap) > 2 * len(self.counts) + 16:
+                self.heap = [self.sign * x for x in self.counts]
+                heapq.heapify(self.heap)
+                self.in_heap = set(self.counts)
+
+    def result(self):
+        while len(self.heap) > 0 and self.sign * self.heap[0] not in self.counts:
+            self.in_heap.discard(self.sign * heapq.heappop(self.heap))
+        if len(self.heap) == 0:
+            return None
+        return self.sign * self.heap[0]
+
+
+class Max(Min):
+    """The maximum of a numeric field"""
+
+    name = 'max'
+    sign = -1
+
+
+REDUCERS = {'count': Count, 'group': GroupBy, 'sum': Sum, 'min': Min, 'max': Max}
+
+
+def make_reducer(spec):
+    """
+    :param spec: a reducer or its description, one of count, group:path, sum:path, min:path, max:path
+    :return: the reducer
+    """
+    if not isinstance(spec, str):
+        return spec
+    (name, _, path) = spec.partition(':')
+    if name not in REDUCERS or (name != 'count') != (path != ''):
+        raise ValueError('Invalid reducer {}'.format(spec))
+    if name == 'count':
+        return Count()
+    return REDUCERS.get(name)(path)
+
+
+class Aggregate(object):
+    """An aggregate of the values of the keys matching a pattern, maintained incrementally.
+
+    The contribution and the version of each key are kept so that an update replaces the
+    previous contribution of the key and that older versions, e.g. delivered by a resolution
+    racing with the updates, are ignored.
+    """
+
+    def __init__(self, name, pattern, reducer, where=None):
+        """
+        :param name: the name of the aggregate
+        :param pattern: the pattern of the keys, can contain wildcards
+        :param reducer: the reducer or its description, see make_reducer
+        :param where: if given, the predicate the values have to match, see dstore.query
+        """
+        self.name = name
+        self.pattern = pattern
+        self.reducer = make_reducer(reducer)
+        self.query = Query(where)
+        self.entries = {}  # key -> (version, contribution)
+        self.lock = threading.Lock()
+
+    def __contribution(self, value):
+        if value is None:
+            return None
+        if len(self.query.conditions) > 0:
+            data = json_value(value)
+            if not isinstance(data, (dict, list)) or not self.query.matches(data):
+                return None
+        return self.reducer.extract(value)
+
+    def update(self, key, value, version):
+        """Applies a change of a key, a None value removes the key
+
+        :return: True if the aggregate was changed
+        """
+        if not fnmatch.fnmatch(key, self.pattern):
+            return False
+        c = self.__contribution(value)
+        with self.lock:
+            old = self.entries.get(key)
+            if old is not None and value is not None and version is not None and old[0] is not None \
+                    and version < old[0]:
+                return False
+            # the version of a key that does not match is kept as well, to ignore the older values
+            if old is not None:
+                del self.entries[key]
+                if old[1] is not None:
+                    self.reducer.remove(old[1])
+            if value is not None:
+                self.entries[key] = (version, c)
+                if c is not None:
+                    self.reducer.add(c)
+            return (old is not None and old[1] is not None) or c is not None
+
+    def value(self):
+        with self.lock:
+            return self.reducer.result()
+
+    def status(self):
+        with self.lock:
+            return {'pattern': self.pattern, 'reducer': self.reducer.name, 'where': self.query.where,
+                    'keys': sum(1 for (_, c) in self.entries.values() if c is not None),
+                    'value': self.reducer.result()}
@@ -0,0 +1,184 @@
+import base64
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Codecs of the typed values.
+#
+# A typed value is encoded once, when it is put, and is then stored, published and resolved
+# as the encoded bytes together with the name of its codec, the bytes are decoded only when
+# the value is read in its decoded form, e.g. by dput. Values put without codec are stored
+# as they are given, as strings, as before.
+
+
+class Codec(object):
+    """Encodes values to bytes and decodes them back"""
+
+    name = None
+    id = None  # identifies the codec in the snapshots
+
+    def encode(self, obj):
+        raise NotImplementedError
+
+    def decode(self, data):
+        raise NotImplementedError
+
+
+class RawCodec(Codec):
+    """Bytes, kept as they are"""
+
+    name = 'raw'
+    id = 0
+
+    def encode(self, obj):
+        if isinstance(obj, bytes):
+            return obj
+        if isinstance(obj, (bytearray, memoryview)):
+            # the buffer may be changed by its owner once put returns
+            return bytes(obj)
+        if isinstance(obj, str):
+            return obj.encode('utf-8')
+        raise TypeError('raw values are bytes, not {}'.format(type(obj).__name__))
+
+    def decode(self, data):
+        return data
+
+
+class JsonCodec(Codec):
+    name = 'json'
+    id = 1
+
+    def encode(self, obj):
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    def decode(self, data):
+        return json.loads(str(data, 'utf-8'))
+
+
+class MsgpackCodec(Codec):
+    """MessagePack, available when the msgpack package is installed"""
+
+    name = 'msgpack'
+    id = 2
+
+    def encode(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+CODECS = {}
+
+
+def register_codec(codec):
+    """
+    :param codec: the codec, its name and id have to be unique
+    """
+    CODECS[codec.name] = codec
+
+
+def get_codec(codec):
+    """
+    :param codec: a codec or its name
+    :return: the codec
+    """
+    if isinstance(codec, Codec):
+        return codec
+    c = CODECS.get(codec)
+    if c is None:
+        if codec == 'msgpack':
+            raise ValueError('The msgpack codec requires the msgpack package')
+        raise ValueError('Unknown codec {}'.format(codec))
+    return c
+
+
+def codec_by_id(i):
+    for c in list(CODECS.values()):
+        if c.id == i:
+            return c
+    raise ValueError('Unknown codec id {}'.format(i))
+
+
+register_codec(RawCodec())
+register_codec(JsonCodec())
+if msgpack is not None:
+    register_codec(MsgpackCodec())
+
+
+class Value(object):
+    """A value encoded by a codec"""
+
+    def __init__(self, codec, data):
+        """
+        :param codec: the name of the codec
+        :param data: the encoded bytes
+        """
+        self.codec = codec
+        self.data = data
+
+    @staticmethod
+    def encode(codec, obj):
+        """
+        :param codec: a codec or its name
+        :param obj: the value, a Value encoded by the same codec is returned as it is
+        :return: the Value
+        """
+        c = get_codec(codec)
+        if isinstance(obj, Value):
+            if obj.codec == c.name:
+                return obj
+            obj = obj.decode()
+        return Value(c.name, c.encode(obj))
+
+    def decode(self):
+        return get_codec(self.codec).decode(self.data)
+
+    def view(self):
+        """
+        :return: a memoryview of the encoded bytes, nothing is copied
+        """
+        return memoryview(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __eq__(self, other):
+        return isinstance(other, Value) and self.codec == other.codec and self.data == other.data
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.codec, self.data))
+
+    def __str__(self):
+        return str(jsonable(self)) if self.codec == 'raw' else json.dumps(jsonable(self))
+
+    def __repr__(self):
+        return 'Value(codec = {0}, {1} bytes)'.format(self.codec, len(self.data))
+
+
+def decode(v):
+    """
+    :return: the decoded form of a value, the values without codec are returned as they are
+    """
+    if isinstance(v, Value):
+        return v.decode()
+    return v
+
+
+def jsonable(v):
+    """
+    :return: a form of a value that can be serialized as JSON, the raw values being base64 encoded
+    """
+    if isinstance(v, Value):
+        if v.codec == 'raw':
+            return str(base64.b64encode(v.data), 'ascii')
+        return v.decode()
+    if isinstance(v, bytes):
+        return str(base64.b64encode(v), 'ascii')
+    return v
@@ -1,13 +1,31 @@
 from .abstract_store import *
 from .types import  *
 from .logger import *
+from .timer import TimerService
+from .membership import Membership
+from .rtt import RttTable
+from .tracing import TraceContext
+from .profiler import get_profiler
+from .codec import Value
 from cdds import *
+import collections
 import copy
+import fnmatch
+import threading
 import time
 from time import sleep
 import random
 
 the_dds_controller = None
+the_dds_controller_lock = threading.Lock()
+
+
+def payload_size(v):
+    if v is None:
+        return 0
+    if isinstance(v, (str, bytes, Value)):
+        return len(v)
+    return len(str(v))
 
 
 class DDSController:
@@ -27,6 +45,12 @@ class DDSController:
         self.hitmv_topic = FlexyTopic(self.dp, "FOSStoreHitMV")
         self.pubMap = {}
         self.subMap = {}
+        self.writerMap = {}
+        self.demuxMap = {}
+        self.lock = threading.RLock()
+        self.timer = TimerService()
+        self.profiler = get_profiler()
+        self.users = 0
 
     def get_pub(self, path):
         p = None
@@ -44,32 +68,139 @@ class DDSController:
             s = self.subMap[path]
         else:
             s = Subscriber(self.dp, Publisher.partition(path))
-            self.pubMap[path] = s
+            self.subMap[path] = s
 
         return s
 
+    def get_writer(self, path, topic, state):
+        """
+            Returns the writer of a topic on a partition, shared by all the stores of this process
+        """
+        with self.lock:
+            k = (path, topic.name)
+            w = self.writerMap.get(k)
+            if w is None:
+                w = FlexyWriter(self.get_pub(path), topic, state)
+                self.writerMap[k] = w
+            return w
+
+    def get_demux(self, path, topic, state):
+        """
+            Returns the demultiplexer of the samples of a topic on a partition, shared by all the
+            stores of this process
+        """
+        with self.lock:
+            k = (path, topic.name)
+            d = self.demuxMap.get(k)
+            if d is None:
+                name = '{}@{}'.format(topic.name, path)
+                d = SampleDemux(self.get_sub(path), topic, state, lambda h: self.profiler.wrap(None, name, h))
+                self.demuxMap[k] = d
+            return d
+
 
     @staticmethod
     def controller():
         global the_dds_controller
-        if the_dds_controller is not None:
-            return the_dds_controller
-        else:
-            the_dds_controller = DDSController()
-            return the_dds_controller
+        with the_dds_controller_lock:
+            if the_dds_controller is not None:
+                return the_dds_controller
+            else:
+                the_dds_controller = DDSController()
+                return the_dds_controller
+
+    @staticmethod
+    def attach():
+        """
+            Returns the controller of the process and registers a new user of it
+        """
+        c = DDSController.controller()
+        with the_dds_controller_lock:
+            c.users = c.users + 1
+        return c
+
+    def detach(self):
+        """
+            Unregisters a user of the controller, the DDS runtime is closed when the last user detaches
+        """
+        global the_dds_controller
+        with the_dds_controller_lock:
+            self.users = self.users - 1
+            if self.users > 0:
+                return
+            if the_dds_controller is self:
+                the_dds_controller = None
+        self.close()
 
     def close(self):
+        self.timer.stop()
         self.dds_runtime.close()
 
+class SampleDemux(object):
+    """
+        Reads the samples of a topic on a partition once and fans them out to the handlers
+        registered by the local stores. Handlers receive the list of (sample, info) taken
+        from the reader and must not modify them.
+    """
+
+    def __init__(self, sub, topic, state, wrap=lambda h: h):
+        self.handlers = []
+        self.liveliness_handlers = []
+        self.lock = threading.Lock()
+        # The whole fan-out is timed by the profiler of the process
+        self.dispatch = wrap(self.dispatch)
+        self.reader = FlexyReader(sub, topic, self.on_data_available, state)
+        self.reader.on_liveliness_changed(self.on_liveliness_changed)
+
+    def add(self, handler, liveliness_handler=None):
+        with self.lock:
+            self.handlers = self.handlers + [handler]
+            if liveliness_handler is not None:
+                self.liveliness_handlers = self.liveliness_handlers + [liveliness_handler]
+
+    def remove(self, handler, liveliness_handler=None):
+        with self.lock:
+            self.handlers = [h for h in self.handlers if h != handler]
+            self.liveliness_handlers = [h for h in self.liveliness_handlers if h != liveliness_handler]
+
+    def on_data_available(self, r):
+        samples = list(r.take(DDS_ANY_STATE))
+        if len(samples) > 0:
+            self.dispatch(samples)
+
+    def dispatch(self, samples):
+        for h in self.handlers:
+            h(samples)
+
+    def on_liveliness_changed(self, r, status):
+        samples = list(r.take(DDS_NOT_ALIVE_NO_WRITERS_INSTANCE_STATE | DDS_NOT_ALIVE_DISPOSED_INSTANCE_STATE))
+        for h in self.liveliness_handlers:
+            h(samples)
+
+
 class StoreController (AbstractController, Observer):
     MAX_SAMPLES = 64
     DISPOSED_INSTANCE = 32
+    MAX_RETRANSMISSIONS = 3
 
     def __init__(self, store):
         super(StoreController, self).__init__()
-        self.dds_controller = DDSController.controller()
+        self.dds_controller = DDSController.attach()
         self.logger = DLogger()
         self.__store = store
+        self.membership = Membership()
+        self.advertise_handle = None
+        self.advertise_pending = False
+        self.advertise_lock = threading.Lock()
+        self.liveliness_handle = None
+        self.rtt = RttTable()
+
+        self.metrics = store.metrics
+        self.m_published = self.metrics.counter('published_bytes_total', 'Bytes of the values published by this store')
+        self.m_received = self.metrics.counter('received_bytes_total', 'Bytes of the values received by this store')
+        self.m_retransmissions = self.metrics.counter('resolve_retransmissions_total', 'Misses sent again for lack of answers')
+        self.m_served = self.metrics.counter('misses_served_total', 'Misses of other stores answered by this store')
+        self.metrics.gauge('heartbeat_interval_seconds', self.membership.interval, 'Interval between two advertisements of this store')
 
         self.dp = self.dds_controller.dp
 
@@ -86,84 +217,189 @@ class StoreController (AbstractController, Observer):
         self.hitmv_topic = self.dds_controller.hitmv_topic
 
 
-        self.store_info_writer = FlexyWriter(self.pub,
-                                             self.store_info_topic,
-                                             DDS_State)
+        self.store_info_writer = self.dds_controller.get_writer(self.__store.root, self.store_info_topic, DDS_State)
 
-        self.store_info_reader = FlexyReader(self.sub,
-                                            self.store_info_topic,
-                                            self.cache_discovered,
-                                             DDS_State)
+        # Readers are shared by all the stores of the process, the samples are received through demultiplexers
+        self.demuxes = []
+        self.__attach(self.__store.root, self.store_info_topic, DDS_State, self.cache_discovered, self.cache_disappeared)
 
+        # The KeyValue traffic is partitioned in shards, see shard_of
+        self.shard_depth = self.__store.shard_depth
+        self.key_value_writers = {}
+        self.key_value_partitions = []
 
-        self.store_info_reader.on_liveliness_changed(self.cache_disappeared)
+        if self.__store.eager_cache:
+            self.subscribe(self.__store.root)
+        self.subscribe(self.__store.home)
 
-        self.key_value_writer = FlexyWriter(self.pub,
-                                            self.key_value_topic,
-                                            DDS_State)
+        self.miss_writer = self.dds_controller.get_writer(self.__store.root, self.miss_topic, DDS_Event)
 
-        self.key_value_reader = FlexyReader(self.sub,
-                                            self.key_value_topic,
-                                            self.handle_remote_put,
-                                            DDS_State)
+        self.__attach(self.__store.root, self.miss_topic, DDS_Event, self.handle_miss)
 
-        self.key_value_reader = FlexyReader(self.sub,
-                                            self.key_value_topic,
-                                            self.log_samples,
-                                            DDS_State)
+        self.hit_writer = self.dds_controller.get_writer(self.__store.root, self.hit_topic, DDS_Event)
 
+        # Hits addressed to this store are delivered to the resolutions waiting for their key
+        self.hits_cv = threading.Condition()
+        self.hits = {}
+        self.__attach(self.__store.root, self.hit_topic, DDS_Event, lambda xs: self.__enqueue_hits(self.hits, xs), name='enqueue_hits')
 
-        self.miss_writer = FlexyWriter(self.pub,
-                                       self.miss_topic,
-                                       DDS_Event)
+        self.missmv_writer = self.dds_controller.get_writer(self.__store.root, self.missmv_topic, DDS_Event)
 
-        self.miss_reader = FlexyReader(self.sub,
-                                       self.miss_topic,
-                                       self.handle_miss,
-                                       DDS_Event)
+        self.__attach(self.__store.root, self.missmv_topic, DDS_Event, self.handle_miss_mv)
 
+        self.hitmv_writer = self.dds_controller.get_writer(self.__store.root, self.hitmv_topic, DDS_Event)
 
-        self.hit_writer = FlexyWriter(self.pub,
-                                       self.hit_topic,
-                                       DDS_Event)
+        self.hitsmv = {}
+        self.metrics.gauge('resolve_pending', self.pending_resolutions, 'Resolutions waiting for answers')
+        self.__attach(self.__store.root, self.hitmv_topic, DDS_Event, lambda xs: self.__enqueue_hits(self.hitsmv, xs), name='enqueue_hits')
 
-        self.hit_reader = FlexyReader(self.sub,
-                                       self.hit_topic,
-                                      None,
-                                      DDS_Event)
+    def __attach(self, path, topic, state, handler, liveliness_handler=None, name=None):
+        if name is None:
+            name = handler.__name__
+        h = self.dds_controller.profiler.wrap(self.__store.store_id, '{}.{}'.format(topic.name, name), handler)
+        d = self.dds_controller.get_demux(path, topic, state)
+        d.add(h, liveliness_handler)
+        self.demuxes.append((d, h, liveliness_handler))
 
+    def __enqueue_hits(self, waiters, samples):
+        t = time.time()
+        with self.hits_cv:
+            for (d, i) in samples:
+                if i.valid_data and d.dest_sid == self.__store.store_id:
+                    for q in waiters.get(d.key, []):
+                        q.append((d, t))
+            self.hits_cv.notify_all()
 
-        self.missmv_writer = FlexyWriter(self.pub,
-                                         self.missmv_topic,
-                                         DDS_Event)
-
-        self.missmv_reader = FlexyReader(self.sub,
-                                         self.missmv_topic,
-                                         lambda r: self.handle_miss_mv(r),
-                                         DDS_Event)
-
-
-
-        self.hitmv_writer = FlexyWriter(self.pub,
-                                        self.hitmv_topic,
-                                        DDS_Event)
-
-
-        self.hitmv_reader = FlexyReader(self.sub,
-                                        self.hitmv_topic,
-                                        None,
-                                        DDS_Event)
-
+    def pending_resolutions(self):
+        with self.hits_cv:
+            return sum(len(xs) for xs in self.hits.values()) + sum(len(xs) for xs in self.hitsmv.values())
 
+    def __answer_size(self, d):
+        if isinstance(d, CacheHitMV):
+            return sum(payload_size(x[1]) for x in (d.kvave or []))
+        return payload_size(d.value)
 
-    def log_samples(self, dr):
-        for (s, i) in dr.read(all_samples()):
-            if i.valid_data:
-                self.logger.debug('DController', str(s))
+    def __exchange(self, writer, waiters, m, uri, timeout=None, min_answers=None):
+        """
+            Sends a miss and collects the answers of the peers. The miss is retransmitted when
+            some of the known stores did not answer within the retransmission timeout derived
+            from their round trip times, the timeout doubles at each retransmission.
+
+            :param writer: the writer of the miss
+            :param waiters: the table of the queues receiving the answers
+            :param m: the miss
+            :param uri: the key of the answers
+            :param timeout: if given, the maximum time to wait for the answers
+            :param min_answers: if given, the exchange ends as soon as this many stores have answered
+            :return: an iterator of the first answer of each store, delivered as they arrive
+        """
+        q = collections.deque()
+        peers = set(self.__store.discovered_stores.keys())
+        answers = {}
+        with self.hits_cv:
+            waiters.setdefault(uri, []).append(q)
+        try:
+            t_start = time.time()
+            t_end = None if timeout is None else t_start + timeout
+            t_sent = t_start
+            rto = self.rtt.rto(peers)
+            transmissions = 0
+            writer.write(m)
+            done = False
+            while not done:
+                fresh = []
+                with self.hits_cv:
+                    while len(q) > 0:
+                        (d, t) = q.popleft()
+                        self.m_received.inc(self.__answer_size(d))
+                        if d.source_sid not in answers:
+                            answers[d.source_sid] = d
+                            fresh.append(d)
+                            self.metrics.counter('resolve_answers_total', 'Answers received from each peer', peer=d.source_sid).inc()
+                            # Answers to a retransmitted miss are ambiguous and are not measured
+                            if transmissions == 0:
+                                self.rtt.sample(d.source_sid, t - t_sent)
+                    t_now = time.time()
+                    t_next = t_sent + rto
+                    if min_answers is not None and len(answers) >= min_answers:
+                        done = True
+                    elif len(peers) > 0 and peers.issubset(answers.keys()):
+                        done = True
+                    elif len(fresh) > 0:
+                        pass
+                    elif t_end is not None and t_now >= t_end:
+                        done = True
+                    elif t_now >= t_next:
+                        if len(peers) == 0 or transmissions >= self.MAX_RETRANSMISSIONS:
+                            done = True
+                        else:
+                            missing = peers.difference(answers.keys())
+                            self.logger.debug('DController', '>>>> Retransmitting miss on {} for {}'.format(uri, missing))
+                            transmissions += 1
+                            self.m_retransmissions.inc()
+                            # exponential backoff, rto already covers the missing peers
+                            rto = min(2 * rto, self.rtt.max_rto)
+                            t_sent = t_now
+                            writer.write(m)
+                    else:
+                        self.hits_cv.wait(t_next - t_now if t_end is None else min(t_next, t_end) - t_now)
+                # the answers are delivered out of the lock, while the next ones are received
+                for d in fresh:
+                    yield d
+        finally:
+            with self.hits_cv:
+                waiters[uri].remove(q)
+                if len(waiters[uri]) == 0:
+                    waiters.pop(uri)
+        self.logger.debug('DController', '>>>> Miss on {} answered by {} of {} peers after {} retransmissions'.format(
+            uri, len(answers), len(peers), transmissions))
+
+    def shard_of(self, uri):
+        """
+            Returns the partition on which the updates of an URI are published. The partition
+            is made of the root followed by the first *shard_depth* segments of the URI below the root.
+        """
+        root = self.__store.root
+        if self.shard_depth == 0 or not uri.startswith(root):
+            return root
+        xs = [x for x in uri[len(root):].split('/') if x != '']
+        return '/'.join([root.rstrip('/')] + xs[:self.shard_depth])
 
-    def handle_miss(self, r):
+    def shards_of(self, uri):
+        """
+            Returns the partition expressions matching all the shards that may hold URIs matching the given one
+        """
+        if self.shard_depth == 0:
+            return [self.__store.root]
+        xs = [x for x in uri[len(self.__store.root):].split('/') if x != '']
+        p = self.shard_of(uri)
+        if len(xs) < self.shard_depth:
+            # the expressions follow the segments, thus the siblings sharing a prefix, e.g. r2 for r,
+            # are not matched
+            return [p, p.rstrip('/') + '/*']
+        return [p]
+
+    def subscribe(self, uri):
+        """
+            Subscribes to the KeyValue updates of the shards that may hold URIs matching the given one
+        """
+        for p in self.shards_of(uri):
+            if any(fnmatch.fnmatch(p, q) for q in list(self.key_value_partitions)):
+                continue
+            self.logger.debug('DController', 'Subscribing to partition {}'.format(p))
+            self.key_value_partitions.append(p)
+            self.__attach(p, self.key_value_topic, DDS_State, self.handle_remote_put)
+
+    def __key_value_writer(self, uri):
+        p = self.shard_of(uri)
+        w = self.key_value_writers.get(p)
+        if w is None:
+            w = self.dds_controller.get_writer(p, self.key_value_topic, DDS_State)
+            self.key_value_writers[p] = w
+        return w
+
+    def handle_miss(self, samples):
         self.logger.debug('DController.handle_miss','Handling Miss for store {0}'.format(self.__store.store_id))
-        samples = r.take(all_samples())
         v = None
         for (d, i) in samples:
             if i.valid_data and (d.source_sid != self.__store.store_id):
@@ -180,8 +416,10 @@ class StoreController (AbstractController, Observer):
 
                 if v is not None:
                     self.logger.debug('DController.handle_miss', 'Serving Miss for {} with {} -> {}'.format(d.key,v[0],v[1]))
-                    h = CacheHit(self.__store.store_id, d.source_sid, d.key, v[0], v[1])
+                    h = CacheHit(self.__store.store_id, d.source_sid, d.key, v[0], v[1], self.__lease(d.key))
                     self.hit_writer.write(h)
+                    self.m_served.inc()
+                    self.m_published.inc(payload_size(v[0]))
                 else:
                     self.logger.debug('DController.handle_miss', 'Store {0} did not resolve remote miss on key {1}'.format(
                         self.__store.store_id, d.key))
@@ -190,9 +428,8 @@ class StoreController (AbstractController, Observer):
 
 
 
-    def handle_miss_mv(self, r):
+    def handle_miss_mv(self, samples):
         self.logger.info('DController','>>>> Handling Miss MV for store {0}'.format(self.__store.store_id))
-        samples = r.take(all_samples())
         xs = []
         for (d, i) in samples:
             if i.valid_data and (d.source_sid != self.__store.store_id):
@@ -203,27 +440,29 @@ class StoreController (AbstractController, Observer):
                         va = self.__store.get_metaresources().get(u)(''.join(d.key.rsplit(u, 1)))
                         xs = [(d.key, va, 0)]
                 else:
-                    xs = self.__store.getAll(d.key)
+                    xs = self.__store.getAll(d.key, getattr(d, 'where', None), getattr(d, 'select', None))
 
                 if len(xs) == 0:
                     xs = None
 
                 self.logger.debug('DController','>>>> Serving Miss MV for key {} store: {} data: {}'.format(d.key, d.source_sid, xs))
                 h = CacheHitMV(self.__store.store_id, d.source_sid, d.key, xs)
-                r_sleep = random.randint(1, 75)/100
-                time.sleep(r_sleep)
                 self.hitmv_writer.write(h)
+                self.m_served.inc()
+                if xs is not None:
+                    self.m_published.inc(sum(payload_size(x[1]) for x in xs))
 
 
     def handle_remove(self, uri):
         self.logger.debug('DController','>>>> Removing {0}'.format(uri))
         self.__store.remote_remove(uri)
 
-    def handle_remote_put(self, reader):
+    def handle_remote_put(self, samples):
         #print(">>>>>>>>>>>>. handle_remote_put")
-        samples = reader.take(DDS_ANY_SAMPLE_STATE)
 
         for (d, i) in samples:
+            if not self.__store.is_interested(d.key):
+                continue
             self.logger.debug('DController', ">>>>>>>> Handling remote put d.key {0}".format(d.key))
             #print('DController', ">>>>>>>> Handling remote put d.key {0}".format(d.key))
             #print('\t\tSOURCE TIMESTAMP {}'.format(i.source_timestamp))
@@ -234,6 +473,7 @@ class StoreController (AbstractController, Observer):
                 self.handle_remove(d.key)
             elif i.valid_data:
                 #print('>>>>>>>>>>>>. handle_remote_put for UPDATED INSTANCE ', '>>>>> D {0}'.format(d.key))
+                self.m_received.inc(payload_size(d.value))
                 rkey = d.key
                 rsid = d.sid
                 rvalue = d.value
@@ -247,11 +487,16 @@ class StoreController (AbstractController, Observer):
                 if rsid != self.__store.store_id:
                     self.logger.debug('DController',">>>>>>>> Handling remote put in for key = " + rkey)
                     if not self.__is_metaresource(rkey):
-                        r = self.__store.update_value(rkey, rvalue, rversion)
-                        if r:
-                            #print(">> Updated " + rkey)
-                            self.logger.debug('DController', ">> Updated " + rkey)
-                            self.__store.notify_observers(rkey, rvalue, rversion)
+                        trace_id = getattr(d, 'trace_id', None)
+                        ctx = None if trace_id is None else TraceContext(trace_id, d.origin_ts, rsid)
+                        with self.__store.tracer.activate(ctx):
+                            self.__store.tracer.event('receive', rkey, rversion)
+                            r = self.__store.update_value(rkey, rvalue, rversion)
+                            if r:
+                                self.__store.renew_lease(rkey, getattr(d, 'lease', 0))
+                                #print(">> Updated " + rkey)
+                                self.logger.debug('DController', ">> Updated " + rkey)
+                                self.__store.notify_observers(rkey, rvalue, rversion)
                     else:
                         self.logger.debug('DController',">> Received old version of " + rkey)
                 else:
@@ -259,35 +504,37 @@ class StoreController (AbstractController, Observer):
             else:
                 self.logger.debug('DController',">>>>>> Some store unregistered instance {0}".format(d.key))
 
-    def cache_discovered(self, reader):
+    def cache_discovered(self, samples):
         self.logger.debug('DController', 'New Cache discovered, current view = {0}'.format(self.__store.discovered_stores))
-        samples = reader.take(DDS_ANY_SAMPLE_STATE)
-        t_now = time.time()
 
         for (d, i) in samples:
             if i.valid_data:
                 rsid = d.sid
-                self.logger.debug('DController', ">>> Discovered store with id: " + rsid)
                 if rsid != self.__store.store_id:
-                    if rsid not in self.__store.discovered_stores.keys():
+                    self.__store.discovered_stores.update({rsid: time.time()})
+                    if self.membership.heartbeat(rsid, getattr(d, 'interval', None)):
                         self.logger.debug('DController', ">>> Store with id: {} is new!".format(rsid))
-                        self.__store.discovered_stores.update({rsid: time.time()})
-                        self.advertise_presence()
-                    elif rsid in self.__store.discovered_stores.keys():
-                        t_old = self.__store.discovered_stores.get(rsid)
-                        self.logger.debug('DController', ">>> Store with id: {} is old t_old-t_now={}!".format(rsid, t_now - t_old))
-                        if t_now - t_old > 7:
-                            self.advertise_presence()
-                            self.logger.debug('DController', ">>> Responding to advertising at store id: {}".format(rsid))
-
-                        self.__store.discovered_stores.update({rsid: time.time()})
+                        self.__store.on_store_discovered(rsid)
+                        # Let the new store know about this one without waiting for the next heartbeat
+                        self.advertise_soon()
 
             elif i.is_disposed_instance():
                 rsid = d.key
                 self.logger.debug('DController', ">>> Store {0} has been disposed".format(rsid))
-                if rsid in self.__store.discovered_stores:
-                    self.logger.debug('DController', ">>> Removing Store id: " + rsid)
-                    self.__store.discovered_stores.pop(rsid)
+                self.forget_store(rsid)
+
+    def forget_store(self, rsid):
+        self.membership.remove(rsid)
+        self.rtt.remove(rsid)
+        if rsid in self.__store.discovered_stores:
+            self.logger.debug('DController', ">>> Removing Store id: " + rsid)
+            self.__store.discovered_stores.pop(rsid, None)
+            self.__store.on_store_disappeared(rsid)
+
+    def check_liveliness(self):
+        for rsid in self.membership.expired():
+            self.logger.debug('DController', ">>> Store with id {0} has expired".format(rsid))
+            self.forget_store(rsid)
 
     # def cache_discovered(self,reader):
     #     self.logger.debug('DController','New Cache discovered, current view = {0}'.format(self.__store.discovered_stores))
@@ -310,36 +557,40 @@ class StoreController (AbstractController, Observer):
 
 
 
-    def cache_disappeared(self, reader, status):
+    def cache_disappeared(self, samples):
         self.logger.debug('DController',">>> Cache Lifecycle-Change")
         self.logger.debug('DController','Current Stores view = {0}'.format(self.__store.discovered_stores))
-        samples = reader.take(DDS_NOT_ALIVE_NO_WRITERS_INSTANCE_STATE | DDS_NOT_ALIVE_DISPOSED_INSTANCE_STATE)
         for (d, i) in samples:
             if i.valid_data:
                 rsid = d.sid
                 if rsid != self.__store.store_id:
                     if rsid in self.__store.discovered_stores:
-                        self.__store.discovered_stores.remove(rsid)
+                        self.forget_store(rsid)
                         self.logger.debug('DController',">>> Store with id {0} has disappeared".format(rsid))
                     else:
-                        self.logger.debug('DController',">>> Store with id {0} has disappeared, but for some reason we did not know it...")
+                        self.logger.debug('DController',">>> Store with id {0} has disappeared, but for some reason we did not know it...".format(rsid))
+
 
+    def __publish(self, uri, val, ver):
+        ctx = self.__store.tracer.current()
+        v = KeyValue(key = uri , value = val, sid = self.__store.store_id, version = ver, lease = self.__lease(uri),
+                     trace_id = None if ctx is None else ctx.trace_id, origin_ts = None if ctx is None else ctx.origin_ts)
+        self.__key_value_writer(uri).write(v)
+        self.m_published.inc(payload_size(val))
+        self.__store.tracer.event('publish', uri, ver)
 
     def onPut(self, uri, val, ver):
         # self.logger.debug('DController',">> uri: " + uri)
         # self.logger.debug('DController',">> val: " + val)
-        v = KeyValue(key = uri , value = val, sid = self.__store.store_id, version = ver)
-        self.key_value_writer.write(v)
+        self.__publish(uri, val, ver)
 
 
     # One of these for each operation on the cache...
     def onPput(self, uri, val, ver):
-        v = KeyValue(key = uri , value = val, sid = self.__store.store_id, version = ver)
-        self.key_value_writer.write(v)
+        self.__publish(uri, val, ver)
 
     def onDput(self, uri, val, ver):
-        v = KeyValue(key = uri , value = val, sid = self.__store.store_id, version = ver)
-        self.key_value_writer.write(v)
+        self.__publish(uri, val, ver)
 
 
     def onGet(self, uri):
@@ -348,11 +599,11 @@ class StoreController (AbstractController, Observer):
 
     def onRemove(self, uri):
         v = KeyValue(key=uri, value=uri, sid=self.__store.store_id, version=0)
-        self.key_value_writer.dispose_instance(v)
+        self.__key_value_writer(uri).dispose_instance(v)
 
 
     def onObserve(self, uri, action):
-        pass
+        self.subscribe(uri)
         # self.logger.debug('DController',"onObserve Not yet...")
 
     def onMiss(self):
@@ -363,101 +614,24 @@ class StoreController (AbstractController, Observer):
         pass
         # self.logger.debug('DController',"onConflict Not yet...")
 
-    def resolveAll(self, uri, timeout = None):
-        self.logger.info('DController', '>>>> Handling {0} Miss MV for store {1}'.format(uri, self.__store.store_id))
-
-        self.logger.info('DController', ">> Trying to resolve {}".format(uri))
+    def resolveAll(self, uri, timeout = None, where = None, select = None):
         """
             Tries to resolve this URI (with wildcards) across the distributed caches
             :param uri: the URI to be resolved
+            :param timeout: if given, the maximum time to wait for the answers
+            :param where: if given, the predicate the values have to match, evaluated by the answering stores
+            :param select: if given, the fields of the values to return, projected by the answering stores
             :return: the [value], if something is found
         """
-        # @TODO: This should be in the config...
-        #delta = 0.010
-        time.sleep(0.450)
-        delta = 0.250
-        if timeout is None:
-            timeout = delta
-
-        flag = False
-        peers = copy.deepcopy(self.__store.discovered_stores)
-        count = 0
-        while not flag and count < 10:
-            if len(peers) == 0:
-                time.sleep(0.01)
-                peers = copy.deepcopy(self.__store.discovered_stores)
-            else:
-                flag = True
-            count = count + 1
-
-
-        m = CacheMissMV(self.__store.store_id, uri)
-        self.missmv_writer.write(m)
-
-
-
-        retries = 0
-        values = []
-
-        maxRetries = max(min(len(peers)*5, 10), 50)
-        peers_id = []
-        answers = []
-        flag = False
-
-        while not flag:
-            self.logger.debug('DController', ">>>>>>>>>>>>> Resolver starting loop #{} with peers: {} answers: {}".format(retries, len(peers), len(answers)))
-            sleep(0.2)
-            samples = list(self.hitmv_reader.take(DDS_ANY_STATE))
-            if retries > 0 and (retries % 10) == 0:
-                self.logger.debug('DController',">>>> Resolve loop #{} sending another miss!!".format(retries))
-                self.missmv_writer.write(m)
-                sleep(0.4)
-            if retries > maxRetries:
-                self.logger.debug('DController',">>>> Reached max retries giving up!")
-                flag = True
-
-
-
-            self.logger.debug('DController',">>>> Resolve loop #{} got {} samples -> {}".format(retries, len(samples), samples))
-            for s in samples:
-                d = s[0]
-                i = s[1]
-                self.logger.debug('DController',"Is valid data: {0}".format(i.valid_data))
-                self.logger.debug('DController',"Key: {0}".format(d.key))
-                if i.valid_data:
-                    self.logger.debug('DController',"Reveived data from store {0} for store {1} on key {2}".format(d.source_sid, d.dest_sid, d.key))
-                    self.logger.debug('DController',"I was looking to resolve uri: {0}".format(uri))
-                    self.logger.debug('DController','>>>>>>>>> VALUE {0} KVAVE {1}'.format(values, d.kvave))
-                    # Only remove if this was an answer for this key!
-                    # if d.source_sid in peers and uri == d.key:
-                    #     peers.remove(d.source_sid)
-                    if d.source_sid not in answers:
-                        self.logger.debug('DController', "New answer from {}".format(d.source_sid))
-                        answers.append(d.source_sid)
-                        if d.key == uri and d.kvave is not None: # and d.dest_sid == self.__store.store_id:
-                            values = values + d.kvave
-                    else:
-                        self.logger.debug('DController', "Already got an answer from {}".format(d.source_sid))
-
-            if len(peers) == len(answers):
-                self.logger.debug('DController',">>>> All peers answered!")
-                flag = True
-
-
-            self.logger.debug('DController', ">>>>>>>>>>>>> Resolver finishing loop #{} with peers: {} answers: {}".format(retries, len(peers), len(answers)))
-            retries = retries+1
-
+        self.logger.info('DController', '>>>> Handling {0} Miss MV for store {1}'.format(uri, self.__store.store_id))
 
+        values = list(self.iterResolveAll(uri, timeout, where, select))
 
         # now we need to consolidate values
         self.logger.debug('DController', 'Resolved Values = {0}'.format(values))
 
-        #values = list(set(values))
-
         filtered_values = {}
 
-
-
         for (k, va, ve) in values:
             if k not in filtered_values:
                 filtered_values.update({k: (k ,va ,ve)})
@@ -465,72 +639,59 @@ class StoreController (AbstractController, Observer):
                 if ve > filtered_values.get(k)[2]:
                     filtered_values.update({k: (k, va, ve)})
 
-
-
         self.logger.debug('DController',"Filtered Values = {0}".format(filtered_values))
         return list(filtered_values.values())
 
-    def resolve(self, uri, timeout = None):
-        self.logger.debug('DController','>>>> Handling {0} Miss for store {1}'.format(uri, self.__store.store_id))
-
-        self.logger.debug('DController',">> Trying to resolve {}".format(uri))
+    def iterResolveAll(self, uri, timeout = None, where = None, select = None):
+        """
+            Same as resolveAll but iterates over the entries of each store as its answer arrives,
+            the entries are not consolidated, thus a key may be returned by several stores
+            :return: an iterator of (key, value, version)
+        """
+        m = CacheMissMV(self.__store.store_id, uri, where, select)
+        for d in self.__exchange(self.missmv_writer, self.hitsmv, m, uri, timeout):
+            self.logger.debug('DController', "Reveived data from store {0} for store {1} on key {2}".format(d.source_sid, d.dest_sid, d.key))
+            if d.kvave is not None:
+                for x in d.kvave:
+                    yield x
+
+    def resolve(self, uri, timeout = None, min_answers = None):
         """
             Tries to resolve this URI on across the distributed caches
             :param uri: the URI to be resolved
+            :param timeout: if given, the maximum time to wait for the answers
+            :param min_answers: if given, the resolution ends as soon as this many stores have answered
             :return: the value, if something is found
         """
-
-        # @TODO: This should be in the config...
-        time.sleep(0.450)
-        #delta = 0.250
-        delta = 0.250
-        if timeout is None:
-            timeout = delta
-
+        self.logger.debug('DController','>>>> Handling {0} Miss for store {1}'.format(uri, self.__store.store_id))
 
         m = CacheMiss(self.__store.store_id, uri)
-        self.miss_writer.write(m)
-
-        peers = copy.deepcopy(self.__store.discovered_stores)
-        # answers = []
-        self.logger.debug('DController', "Trying to resolve {0} with peers {1}".format(uri, peers))
-        maxRetries = max(len(peers)*2,  10)
-
-        retries = 0
         v = (None, -1)
-        #peers != [] and
-        while retries < maxRetries:
-            time.sleep(timeout + max(retries - 1, 0)/10 * delta)
-        # while peers != answers:
-        #     peers = copy.deepcopy(self.__store.discovered_stores)
-            #sleep(0.2)
-            samples = list(self.hit_reader.take(DDS_ANY_STATE))
-
-            self.logger.debug('DController', ">>>> Resolve loop #{} got {} samples -> {}".format(retries, len(samples), samples))
-
-            # sn = 0
-
-            for (d, i) in samples:
-                # sn += 1
-                if i.valid_data and d.key == uri:
-                    self.logger.debug('DController',"Reveived data from store {0} for store {1} on key {2}".format(d.source_sid, d.dest_sid, d.key))
-                    self.logger.debug('DController',"I was looking to resolve uri: {0}".format(uri))
-                        # # Only remove if this was an answer for this key!
-                        # if d.source_sid in peers and uri == d.key and d.dest_sid == self.__store.store_id:
-                        #     peers.remove(d.source_sid)
-                    if d.key == uri and d.dest_sid == self.__store.store_id:
-                        if int(d.version) > int(v[1]):
-                            v = (d.value, d.version)
-            retries = retries + 1
-
+        lease = 0
+        for d in self.__exchange(self.miss_writer, self.hits, m, uri, timeout, min_answers):
+            self.logger.debug('DController',"Reveived data from store {0} for store {1} on key {2}".format(d.source_sid, d.dest_sid, d.key))
+            if int(d.version) > int(v[1]):
+                v = (d.value, d.version)
+                lease = getattr(d, 'lease', 0) or 0
+            elif int(d.version) == int(v[1]):
+                # only the home store grants a lease, the caching stores answer the same version without
+                lease = max(lease, getattr(d, 'lease', 0) or 0)
+
+        if int(v[1]) >= 0:
+            self.__store.renew_lease(uri, lease)
         return v
-        # if v[0] is not None:
-        #     return v
-        #
-        #     # retries += 1
-        #
-        # return v
 
+    def profile(self):
+        """
+            Returns the profile of the handlers of this store and of the listeners of the process
+        """
+        return self.dds_controller.profiler.report(self.__store.store_id)
+
+    def __lease(self, uri):
+        # Leases are granted only by the home store of the URI
+        if self.__store.is_stored_value(uri):
+            return self.__store.lease_duration
+        return 0
 
     def __is_metaresource(self, uri):
             u = uri.split('/')[-1]
@@ -540,25 +701,34 @@ class StoreController (AbstractController, Observer):
 
     def start(self):
         self.logger.debug('DController', "Advertising Store with Id {0}".format(self.__store.store_id))
-
-        import threading
-        th = threading.Thread(target=self.advertise_presence_timer, args=[0.5])
-        th.setDaemon(True)
-        th.start()
-
-    def advertise_presence_timer(self, timer):
-        self.logger.debug('DController', "Advertising Store with Id {} every {}".format(self.__store.store_id, timer))
-        while True:
-            self.logger.debug('DController', "Advertising Store with Id {}".format(self.__store.store_id))
-            info = StoreInfo(sid=self.__store.store_id, sroot=self.__store.root, shome=self.__store.home)
-            self.store_info_writer.write(info)
-            time.sleep(timer)
-    # def start(self):
-    #     self.logger.debug('DController',"Advertising Store with Id {0}".format(self.__store.store_id))
-    #     self.advertise_presence()
-
-    def advertise_presence(self):
-        info = StoreInfo(sid=self.__store.store_id, sroot=self.__store.root, shome=self.__store.home)
+        # The advertising of all the stores of the process runs on the shared timer, the interval
+        # between two advertisements grows with the number of known stores
+        self.liveliness_handle = self.dds_controller.timer.schedule(self.membership.min_interval,
+                                                                    self.check_liveliness,
+                                                                    period=self.membership.min_interval)
+        self.advertise_presence_timer()
+
+    def advertise_presence_timer(self):
+        interval = self.membership.interval()
+        with self.advertise_lock:
+            self.advertise_pending = False
+            if self.liveliness_handle is None:
+                # the controller has been stopped
+                return
+            self.advertise_handle = self.dds_controller.timer.schedule(interval, self.advertise_presence_timer)
+        self.advertise_presence(interval)
+
+    def advertise_soon(self):
+        with self.advertise_lock:
+            if self.advertise_pending or self.advertise_handle is None:
+                return
+            self.advertise_pending = True
+            self.dds_controller.timer.cancel(self.advertise_handle)
+            # Spread the answers of the stores that discovered the same new store
+            self.advertise_handle = self.dds_controller.timer.schedule(random.uniform(0, 0.1), self.advertise_presence_timer)
+
+    def advertise_presence(self, interval=None):
+        info = StoreInfo(sid=self.__store.store_id, sroot=self.__store.root, shome=self.__store.home, interval=interval)
         self.store_info_writer.write(info)
 
     def pause(self):
@@ -578,6 +748,13 @@ class StoreController (AbstractController, Observer):
 
 
     def stop(self):
+        with self.advertise_lock:
+            self.dds_controller.timer.cancel(self.advertise_handle)
+            self.dds_controller.timer.cancel(self.liveliness_handle)
+            self.advertise_handle = None
+            self.liveliness_handle = None
+        for (d, h, lh) in self.demuxes:
+            d.remove(h, lh)
         info = StoreInfo(sid=self.__store.store_id, sroot=self.__store.root, shome=self.__store.home)
         self.store_info_writer.dispose_instance(info)
-        DDSController.controller().close()
+        self.dds_controller.detach()
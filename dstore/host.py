@@ -0,0 +1,70 @@
+import threading
+import time
+from .store import Store
+
+
+class StoreHost(object):
+    """Hosts many stores in the same process.
+
+    The stores of a process share the DDS readers, writers and the timer of the process, thus
+    creating a store does not spawn threads nor entities.
+    """
+
+    def __init__(self, **kwargs):
+        """Creates a new host.
+
+        :param kwargs: the keyword arguments given to every Store created by this host.
+        """
+        self.__stores = {}
+        self.__lock = threading.Lock()
+        self.__kwargs = kwargs
+
+    def create(self, store_id, root, home, cache_size, sid=None):
+        """Creates a store, if a store with the same id already exists it is returned.
+
+        :param store_id: the store identifier
+        :param root: the root of the store
+        :param home: the home of the store
+        :param cache_size: the cache size of the store
+        :param sid: the identifier of the store among the peers of its root, store_id by default
+        :return: the store
+        """
+        with self.__lock:
+            if store_id not in self.__stores:
+                self.__stores[store_id] = (Store(sid or store_id, root, home, cache_size, **self.__kwargs), time.time())
+            return self.__stores.get(store_id)[0]
+
+    def get(self, store_id):
+        """
+        :param store_id: the store identifier
+        :return: the store, None if no store has this identifier
+        """
+        s = self.__stores.get(store_id)
+        if s is None:
+            return None
+        return s[0]
+
+    def keys(self):
+        """
+        :return: the identifiers of the hosted stores
+        """
+        return list(self.__stores.keys())
+
+    def close(self, store_id):
+        """Closes a store
+
+        :param store_id: the store identifier
+        :return: True if the store existed
+        """
+        with self.__lock:
+            s = self.__stores.pop(store_id, None)
+        if s is None:
+            return False
+        s[0].close()
+        return True
+
+    def close_all(self):
+        """Closes all the stores
+        """
+        for sid in self.keys():
+            self.close(sid)
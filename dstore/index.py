@@ -0,0 +1,150 @@
+import bisect
+import threading
+
+
+def literal_prefix(pattern):
+    """
+    :return: the part of a pattern before its first wildcard
+    """
+    for c in '*?[':
+        pattern = pattern.split(c)[0]
+    return pattern
+
+
+class KeyIndex(object):
+    """The keys of a table kept sorted, for range and prefix scans.
+
+    Keys are kept in a list of sorted chunks of at most *chunk_size* keys, together with the
+    first key of each chunk, so that inserting or removing a key moves at most *chunk_size*
+    references and a scan costs O(log n + k).
+    """
+
+    def __init__(self, chunk_size=1024):
+        self.chunk_size = chunk_size
+        self.__chunks = []
+        self.__firsts = []
+        self.__len = 0
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return self.__len
+
+    def __locate(self, key):
+        # index of the chunk that holds or would hold the key
+        i = bisect.bisect_right(self.__firsts, key) - 1
+        return max(i, 0)
+
+    def add(self, key):
+        """Inserts a key, nothing is done if the key is already indexed"""
+        with self.__lock:
+            if len(self.__chunks) == 0:
+                self.__chunks.append([key])
+                self.__firsts.append(key)
+                self.__len = 1
+                return
+            i = self.__locate(key)
+            c = self.__chunks[i]
+            j = bisect.bisect_left(c, key)
+            if j < len(c) and c[j] == key:
+                return
+            c.insert(j, key)
+            self.__len += 1
+            if j == 0:
+                self.__firsts[i] = key
+            if len(c) > self.chunk_size:
+                h = len(c) // 2
+                self.__chunks.insert(i + 1, c[h:])
+                self.__firsts.insert(i + 1, c[h])
+                del c[h:]
+
+    def remove(self, key):
+        """Removes a key, nothing is done if the key is not indexed"""
+        with self.__lock:
+            if len(self.__chunks) == 0:
+                return
+            i = self.__locate(key)
+            c = self.__chunks[i]
+            j = bisect.bisect_left(c, key)
+            if j == len(c) or c[j] != key:
+                return
+            del c[j]
+            self.__len -= 1
+            if len(c) == 0:
+                del self.__chunks[i]
+                del self.__firsts[i]
+            elif j == 0:
+                self.__firsts[i] = c[0]
+
+    def scan(self, prefix='', start_after=None):
+        """
+        :param prefix: only the keys starting with it are returned
+        :param start_after: if given, only the keys greater than it are returned
+        :return: an iterator of the keys in order, the index may be updated during the iteration
+        """
+        key = prefix
+        inclusive = True
+        if start_after is not None and start_after >= prefix:
+            key = start_after
+            inclusive = False
+        while True:
+            with self.__lock:
+                if len(self.__chunks) == 0:
+                    return
+                i = self.__locate(key)
+                c = self.__chunks[i]
+                j = bisect.bisect_left(c, key) if inclusive else bisect.bisect_right(c, key)
+                xs = c[j:]
+                last = i == len(self.__chunks) - 1
+            for k in xs:
+                if not k.startswith(prefix):
+                    return
+                yield k
+            if last:
+                return
+            if len(xs) > 0:
+                key = xs[-1]
+                inclusive = False
+            else:
+                # the rest of the chunk was empty, continue from the next one
+                with self.__lock:
+                    if i + 1 >= len(self.__firsts):
+                        return
+                    key = self.__firsts[i + 1]
+                    inclusive = True
+
+    def keys(self):
+        with self.__lock:
+            return [k for c in self.__chunks for k in c]
+
+
+class IndexedDict(dict):
+    """A dictionary keeping its keys in a KeyIndex, for scan.
+
+    The index refers to the same key objects as the dictionary, thus it costs a reference per key.
+    """
+
+    def __init__(self):
+        super(IndexedDict, self).__init__()
+        self.__index = KeyIndex()
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self.__index.add(key)
+        super(IndexedDict, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        super(IndexedDict, self).__delitem__(key)
+        self.__index.remove(key)
+
+    def pop(self, key, *default):
+        if key in self:
+            self.__index.remove(key)
+        return super(IndexedDict, self).pop(key, *default)
+
+    def scan(self, prefix='', start_after=None):
+        """
+        :param prefix: only the keys starting with it are returned
+        :param start_after: if given, only the keys greater than it are returned
+        :return: an iterator of the keys in order
+        """
+        return self.__index.scan(prefix, start_after)
@@ -0,0 +1,123 @@
+import collections
+import math
+import threading
+import time
+
+
+class PhiAccrualDetector(object):
+    """Phi accrual failure detector for the heartbeats of a single peer.
+
+    The suspicion level phi is -log10 of the probability that a heartbeat arrives later than
+    the time elapsed since the last one, assuming normally distributed inter-arrival times.
+    """
+
+    def __init__(self, window=64, min_std=0.05):
+        self.intervals = collections.deque(maxlen=window)
+        self.min_std = min_std
+        self.last = None
+        self.announced = None
+
+    def heartbeat(self, t, announced=None):
+        """Records a heartbeat
+
+        :param t: the arrival time
+        :param announced: the heartbeat interval announced by the peer, if any
+        """
+        if self.last is not None:
+            self.intervals.append(t - self.last)
+        self.last = t
+        self.announced = announced
+
+    def phi(self, t):
+        """
+        :param t: the current time
+        :return: the suspicion level of the peer at time t
+        """
+        if self.last is None:
+            return 0.0
+        if len(self.intervals) == 0:
+            # A peer that died after its first heartbeat is judged on the announced interval
+            if self.announced is None:
+                return 0.0
+            (mean, var) = (self.announced, 0.0)
+        else:
+            mean = sum(self.intervals) / len(self.intervals)
+            var = sum((x - mean) ** 2 for x in self.intervals) / len(self.intervals)
+        if self.announced is not None:
+            # The peer may have slowed down its heartbeats since the last samples
+            mean = max(mean, self.announced)
+        std = max(math.sqrt(var), self.min_std, mean / 4)
+        p = 0.5 * math.erfc((t - self.last - mean) / (std * math.sqrt(2)))
+        return -math.log10(max(p, 1e-300))
+
+
+class Membership(object):
+    """Tracks the liveliness of the stores that share a root and computes the heartbeat
+    interval of the local store.
+
+    The heartbeat interval grows with the number of peers so that each store receives at most
+    about *target_rate* heartbeats per second whatever the size of the fleet.
+    """
+
+    def __init__(self, threshold=8.0, min_interval=0.5, max_interval=10.0, target_rate=20.0):
+        """
+        :param threshold: the phi above which a peer is considered dead
+        :param min_interval: the minimum heartbeat interval in seconds
+        :param max_interval: the maximum heartbeat interval in seconds
+        :param target_rate: the number of heartbeats per second each store should receive
+        """
+        self.threshold = threshold
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_rate = target_rate
+        self.__peers = {}
+        self.__lock = threading.Lock()
+
+    def heartbeat(self, sid, announced=None):
+        """Records a heartbeat of a peer
+
+        :param sid: the store id of the peer
+        :param announced: the heartbeat interval announced by the peer
+        :return: True if the peer was not known
+        """
+        with self.__lock:
+            new = sid not in self.__peers
+            if new:
+                self.__peers[sid] = PhiAccrualDetector()
+            self.__peers[sid].heartbeat(time.time(), announced)
+            return new
+
+    def remove(self, sid):
+        """Forgets a peer
+
+        :param sid: the store id of the peer
+        :return: True if the peer was known
+        """
+        with self.__lock:
+            return self.__peers.pop(sid, None) is not None
+
+    def expired(self):
+        """
+        :return: the store ids of the peers whose suspicion level is above the threshold
+        """
+        t = time.time()
+        with self.__lock:
+            return [sid for (sid, d) in self.__peers.items() if d.phi(t) > self.threshold]
+
+    def interval(self):
+        """
+        :return: the heartbeat interval the local store should use
+        """
+        return min(max(len(self.__peers) / self.target_rate, self.min_interval), self.max_interval)
+
+    def status(self):
+        """
+        :return: a dictionary mapping the store id of each peer to its last heartbeat, suspicion level and liveliness
+        """
+        t = time.time()
+        with self.__lock:
+            xs = {}
+            for (sid, d) in self.__peers.items():
+                phi = d.phi(t)
+                xs[sid] = {'last_seen': d.last, 'phi': phi, 'alive': phi <= self.threshold}
+            return xs
@@ -0,0 +1,174 @@
+import bisect
+import threading
+
+
+class Counter(object):
+    """A monotonically increasing value"""
+
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+        self.__lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self.__lock:
+            self.value += n
+
+    def collect(self):
+        return self.value
+
+
+class Gauge(object):
+    """A value sampled when the metrics are collected"""
+
+    kind = 'gauge'
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def collect(self):
+        try:
+            return self.fn()
+        except Exception:
+            return None
+
+
+class Histogram(object):
+    """Counts the observed values in cumulative buckets, as Prometheus does"""
+
+    kind = 'histogram'
+
+    # seconds, from 100us to 10s
+    LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.__lock = threading.Lock()
+
+    def observe(self, v):
+        i = bisect.bisect_left(self.buckets, v)
+        with self.__lock:
+            self.counts[i] += 1
+            self.sum += v
+            self.count += 1
+
+    def collect(self):
+        with self.__lock:
+            counts = list(self.counts)
+            s = self.sum
+            n = self.count
+        cumulative = []
+        acc = 0
+        for (b, c) in zip(list(self.buckets) + ['+Inf'], counts):
+            acc += c
+            cumulative.append((b, acc))
+        return {'count': n, 'sum': s, 'buckets': cumulative}
+
+
+class Metrics(object):
+    """The metrics of a store.
+
+    Metrics are identified by a name and an optional set of labels, e.g. the answers of each
+    peer are counted by ``metrics.counter('resolve_answers', peer=sid)``. Getting a metric
+    creates it on first use, the instances should be kept by the callers on hot paths.
+    """
+
+    def __init__(self, prefix='dstore', **labels):
+        """
+        :param prefix: the prefix of the names of the metrics in the Prometheus format
+        :param labels: the labels added to all the metrics, e.g. the store id
+        """
+        self.prefix = prefix
+        self.labels = labels
+        self.__metrics = {}
+        self.__help = {}
+        self.__lock = threading.Lock()
+
+    def __get(self, name, help, factory, labels):
+        k = (name, tuple(sorted(labels.items())))
+        m = self.__metrics.get(k)
+        if m is None:
+            with self.__lock:
+                m = self.__metrics.get(k)
+                if m is None:
+                    m = factory()
+                    self.__metrics[k] = m
+                    if help is not None:
+                        self.__help[name] = help
+        return m
+
+    def counter(self, name, help=None, **labels):
+        return self.__get(name, help, Counter, labels)
+
+    def histogram(self, name, help=None, buckets=Histogram.LATENCY_BUCKETS, **labels):
+        return self.__get(name, help, lambda: Histogram(buckets), labels)
+
+    def gauge(self, name, fn, help=None, **labels):
+        """
+        :param fn: the function returning the value of the gauge
+        """
+        return self.__get(name, help, lambda: Gauge(fn), labels)
+
+    def snapshot(self):
+        """
+        :return: a dictionary mapping the name of each metric, followed by its labels if any, to its value
+        """
+        with self.__lock:
+            ms = list(self.__metrics.items())
+        xs = {}
+        for ((name, labels), m) in ms:
+            if len(labels) > 0:
+                name = '{}{{{}}}'.format(name, ','.join('{}={}'.format(k, v) for (k, v) in labels))
+            xs[name] = m.collect()
+        return xs
+
+    def samples(self):
+        """
+        :return: the list of (name, kind, help, labels, value) of the metrics
+        """
+        with self.__lock:
+            ms = list(self.__metrics.items())
+        return [('{}_{}'.format(self.prefix, name), m.kind, self.__help.get(name), dict(self.labels, **dict(labels)), m.collect())
+                for ((name, labels), m) in sorted(ms, key=lambda x: x[0])]
+
+
+def _format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{{{}}}'.format(','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                    for (k, v) in sorted(labels.items())))
+
+
+def prometheus_text(registries):
+    """Formats metrics in the Prometheus text exposition format
+
+    :param registries: the Metrics to export, metrics with the same name are grouped
+    :return: the text
+    """
+    groups = {}
+    for r in registries:
+        for (name, kind, help, labels, value) in r.samples():
+            g = groups.setdefault(name, (kind, help, []))
+            g[2].append((labels, value))
+
+    lines = []
+    for name in sorted(groups.keys()):
+        (kind, help, xs) = groups[name]
+        if help is not None:
+            lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for (labels, v) in xs:
+            if v is None:
+                continue
+            if kind == 'histogram':
+                for (b, c) in v['buckets']:
+                    lines.append('{}_bucket{} {}'.format(name, _format_labels(dict(labels, le=b)), c))
+                lines.append('{}_sum{} {}'.format(name, _format_labels(labels), v['sum']))
+                lines.append('{}_count{} {}'.format(name, _format_labels(labels), v['count']))
+            else:
+                lines.append('{}{} {}'.format(name, _format_labels(labels), v))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,150 @@
+import collections
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+
+class HandlerStats(object):
+    __slots__ = ['calls', 'samples', 'total', 'max', 'stalls']
+
+    def __init__(self):
+        self.calls = 0
+        self.samples = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.stalls = 0
+
+    def report(self):
+        return {'calls': self.calls, 'samples': self.samples, 'seconds': self.total, 'max': self.max,
+                'per_call': self.total / self.calls if self.calls > 0 else None,
+                'per_sample': self.total / self.samples if self.samples > 0 else None,
+                'stalls': self.stalls}
+
+
+class HandlerProfiler(object):
+    """Times the handlers of the samples received by the DDS listeners of a process.
+
+    Every handler invocation is timed with the number of samples it processed, and the
+    invocations longer than *threshold* are recorded as stalls: as the listeners are shared
+    by all the stores of the process, a stall delays the processing of all the incoming traffic.
+
+    Profiling is disabled by default, a disabled profiler costs a test per invocation.
+    """
+
+    def __init__(self, threshold=0.05, max_stalls=256):
+        """
+        :param threshold: the duration in seconds above which an invocation is a stall
+        :param max_stalls: the number of stalls kept, older ones are discarded
+        """
+        self.enabled = False
+        self.threshold = threshold
+        self.started = None
+        self.__stats = {}
+        self.__stalls = collections.deque(maxlen=max_stalls)
+        self.__lock = threading.Lock()
+
+    def enable(self, threshold=None):
+        """Starts profiling, the statistics collected so far are discarded
+
+        :param threshold: if given, the new stall threshold
+        """
+        with self.__lock:
+            if threshold is not None:
+                self.threshold = threshold
+            self.__stats = {}
+            self.__stalls.clear()
+            self.started = time.time()
+            self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def wrap(self, owner, name, handler):
+        """
+        :param owner: the id of the store of the handler, None for the handlers of the process
+        :param name: the name of the handler in the reports, e.g. the topic and the function
+        :param handler: the function taking the list of samples
+        :return: the handler, timed when profiling is enabled
+        """
+        k = (owner, name)
+
+        def timed(samples):
+            if not self.enabled:
+                return handler(samples)
+            t = time.time()
+            try:
+                return handler(samples)
+            finally:
+                self.record(k, t, time.time() - t, len(samples))
+
+        return timed
+
+    def record(self, k, t, dt, n):
+        with self.__lock:
+            s = self.__stats.get(k)
+            if s is None:
+                s = HandlerStats()
+                self.__stats[k] = s
+            s.calls += 1
+            s.samples += n
+            s.total += dt
+            if dt > s.max:
+                s.max = dt
+            if dt > self.threshold:
+                s.stalls += 1
+                self.__stalls.append({'store': k[0], 'handler': k[1], 'ts': t, 'seconds': dt, 'samples': n,
+                                      'thread': threading.current_thread().name})
+
+    def report(self, owner=None):
+        """
+        :param owner: if given, only the handlers of this store and of the process are reported
+        :return: a dictionary with the statistics of each handler, sorted by total time, and the recent stalls
+        """
+        with self.__lock:
+            xs = [(k, s.report()) for (k, s) in self.__stats.items() if owner is None or k[0] in (None, owner)]
+            stalls = [s for s in self.__stalls if owner is None or s['store'] in (None, owner)]
+        xs.sort(key=lambda x: -x[1]['seconds'])
+        return {'enabled': self.enabled, 'threshold': self.threshold, 'since': self.started,
+                'handlers': [dict(r, store=k[0], handler=k[1]) for (k, r) in xs],
+                'stalls': stalls}
+
+
+the_profiler = None
+the_profiler_lock = threading.Lock()
+
+
+def get_profiler():
+    """
+    :return: the profiler of the process, enabled at creation if the DSTORE_PROFILE environment
+             variable is set to the stall threshold in seconds
+    """
+    global the_profiler
+    with the_profiler_lock:
+        if the_profiler is None:
+            the_profiler = HandlerProfiler()
+            threshold = os.environ.get('DSTORE_PROFILE')
+            if threshold is not None and threshold != '':
+                the_profiler.enable(float(threshold))
+        return the_profiler
+
+
+def dump_on_signal(signum, out=sys.stderr):
+    """Installs a handler of the given signal writing the profile report of the process to out,
+    the first signal enables the profiling if it was not enabled
+
+    :param signum: the signal, e.g. signal.SIGUSR1
+    :param out: the file where the reports are written
+    """
+    def handler(sig, frame):
+        p = get_profiler()
+        if not p.enabled:
+            p.enable()
+            out.write('Profiling enabled, stall threshold {}s\n'.format(p.threshold))
+        else:
+            out.write(json.dumps(p.report(), indent=2) + '\n')
+        out.flush()
+
+    signal.signal(signum, handler)
@@ -0,0 +1,138 @@
+import json
+from .codec import Value
+
+# Filters and projections evaluated on JSON values, the fields are given as dot paths as in
+# the fragments of dput, e.g. entity_data.memory.
+#
+# A predicate is a list of conditions joined by '&', each one being
+#
+#    path=value     the field is equal to value
+#    path!=value    the field is missing or not equal to value
+#    path           the field is present
+#
+# where value is compared to strings as is and to other values as JSON, thus count=3 and
+# enabled=true match numbers and booleans. A projection is a list of paths joined by ','.
+#
+# The values are either JSON text or typed values, which are decoded by their codec.
+
+
+def get_path(data, path):
+    """
+    :return: the tuple (found, value) of the field at the given dot path
+    """
+    for t in path.split('.'):
+        if isinstance(data, dict) and t in data:
+            data = data.get(t)
+        elif isinstance(data, list) and t.isdigit() and int(t) < len(data):
+            data = data[int(t)]
+        else:
+            return (False, None)
+    return (True, data)
+
+
+def set_path(data, path, value):
+    tokens = path.split('.')
+    for t in tokens[:-1]:
+        data = data.setdefault(t, {})
+    data[tokens[-1]] = value
+
+
+def same_value(field, value):
+    if isinstance(field, str):
+        return field == value
+    try:
+        return field == json.loads(value)
+    except ValueError:
+        return False
+
+
+def decode_json(value):
+    if isinstance(value, Value):
+        return value.decode() if value.codec != 'raw' else None
+    return json.loads(value) if isinstance(value, str) else value
+
+
+def encode_like(value, data):
+    # the projection keeps the codec of the value
+    if isinstance(value, Value):
+        return Value.encode(value.codec, data)
+    return json.dumps(data)
+
+
+class Query(object):
+    """A predicate and a projection on the JSON values of a store"""
+
+    def __init__(self, where=None, select=None):
+        """
+        :param where: the predicate, e.g. status=run&entity_data.memory=2GB
+        :param select: the projection, e.g. status,entity_data.memory
+        """
+        self.where = where or None
+        self.select = select or None
+        self.conditions = []
+        if self.where is not None:
+            for c in self.where.split('&'):
+                if '!=' in c:
+                    (p, v) = c.split('!=', 1)
+                    self.conditions.append((p, '!=', v))
+                elif '=' in c:
+                    (p, v) = c.split('=', 1)
+                    self.conditions.append((p, '=', v))
+                elif c != '':
+                    self.conditions.append((c, None, None))
+        self.paths = []
+        if self.select is not None:
+            self.paths = [p for p in self.select.split(',') if p != '']
+
+    def is_empty(self):
+        return len(self.conditions) == 0 and len(self.paths) == 0
+
+    def matches(self, data):
+        for (p, op, v) in self.conditions:
+            (found, field) = get_path(data, p)
+            if op is None and not found:
+                return False
+            if op == '=' and not (found and same_value(field, v)):
+                return False
+            if op == '!=' and found and same_value(field, v):
+                return False
+        return True
+
+    def project(self, data):
+        if len(self.paths) == 0:
+            return data
+        r = {}
+        for p in self.paths:
+            (found, field) = get_path(data, p)
+            if found:
+                set_path(r, p, field)
+        return r
+
+    def apply(self, entries):
+        """
+        :param entries: an iterable of (key, value, version)
+        :return: the list of the matching (key, value, version), the values being projected
+        """
+        return list(self.filter(entries))
+
+    def filter(self, entries):
+        """
+        Filters and projects entries lazily, the values that are not JSON objects never match a
+        predicate and are returned as they are when there is only a projection.
+
+        :param entries: an iterable of (key, value, version)
+        :return: an iterator of the matching (key, value, version), the values being projected
+        """
+        for (k, va, ve) in entries:
+            if self.is_empty():
+                yield (k, va, ve)
+                continue
+            try:
+                data = decode_json(va)
+            except ValueError:
+                data = None
+            if not isinstance(data, (dict, list)):
+                if len(self.conditions) == 0:
+                    yield (k, va, ve)
+            elif self.matches(data):
+                yield (k, encode_like(va, self.project(data)) if len(self.paths) > 0 else va, ve)
@@ -1,8 +1,16 @@
-from flask import Flask, request
-
-from . import Store
+from flask import Flask, Response, request
+
+from .store import Store
+from .query import Query
+from .codec import Value, jsonable
+from .host import StoreHost
+from .metrics import Metrics, prometheus_text
+import base64
+import hashlib
 import logging
 import json
+import os
+import queue
 import time
 
 
@@ -18,26 +26,56 @@ class RestStore(object):
 
     """
 
-    def __init__(self, address="0.0.0.0", port=5000):
+    CONSISTENCIES = [Store.LOCAL, Store.CACHED_IF_NEWER_THAN, Store.QUORUM]
+
+    def __init__(self, address="0.0.0.0", port=5000, keepalive=15, watch_queue_size=1024, sid_suffix=''):
         """
 
         Create the REST Store Service with given parameters
 
         :param address: IP address where the server has to be accesible (default value 0.0.0.0 [all address of this host])
         :param port: Port number to listen (default 5000)
+        :param keepalive: seconds between two keep-alive comments on idle watch streams
+        :param watch_queue_size: maximum number of pending events per watch stream, older events are dropped
+        :param sid_suffix: appended to the ids of the stores among their peers, the stores are still addressed
+            by their id in the URLs. The stores ignore the messages carrying their own id, thus the processes
+            serving the same store ids need distinct suffixes to see each other
         """
         self.address = address
+        self.sid_suffix = sid_suffix
         self.port = port
-        self.stores = {}
+        self.keepalive = keepalive
+        self.watch_queue_size = watch_queue_size
+        self.host = StoreHost()
         self.app = Flask(__name__)
         self.logger = self.app.logger
         self.app.add_url_rule('/', 'index', self.index, methods=['GET'])
         self.app.add_url_rule('/get/<store_id>/<path:uri>', 'get', self.get, methods=['GET'])
         self.app.add_url_rule('/create/<store_id>', 'create', self.create, methods=['POST'])
+        self.app.add_url_rule('/watch/<store_id>/<path:uri>', 'watch', self.watch, methods=['GET'])
+        self.app.add_url_rule('/mget/<store_id>', 'mget', self.mget, methods=['POST'])
+        self.app.add_url_rule('/scan/<store_id>', 'scan', self.scan, methods=['GET'])
+        self.app.add_url_rule('/scan/<store_id>/<path:prefix>', 'scan', self.scan, methods=['GET'])
         self.app.add_url_rule('/put/<store_id>/<path:uri>', 'put', self.put, methods=['PUT'])
+        self.app.add_url_rule('/mput/<store_id>', 'mput', self.mput, methods=['PUT'])
         self.app.add_url_rule('/dput/<store_id>/<path:uri>', 'dput', self.dput, methods=['PATCH'], )
-        self.app.add_url_rule('/remove/<store_id>/<path:uri>', 'remove', self.destroy, methods=['DELETE'])
+        self.app.add_url_rule('/remove/<store_id>/<path:uri>', 'remove', self.remove, methods=['DELETE'])
         self.app.add_url_rule('/destroy/<store_id>', 'destroy',self.destroy, methods=['DELETE'])
+        self.app.add_url_rule('/metrics', 'metrics', self.metrics_text, methods=['GET'])
+        self.metrics = Metrics(prefix='dstore_rest')
+        self.app.before_request(self.__before_request)
+        self.app.after_request(self.__after_request)
+
+    def __before_request(self):
+        request.environ['dstore.start'] = time.time()
+
+    def __after_request(self, response):
+        t = request.environ.get('dstore.start')
+        if t is not None:
+            self.metrics.histogram('request_seconds', 'Latency of the requests, streams excluded',
+                                   endpoint=request.endpoint).observe(time.time() - t)
+        self.metrics.counter('responses_total', 'Responses sent', endpoint=request.endpoint, status=response.status_code).inc()
+        return response
 
 
     def __close_all_store(self):
@@ -47,9 +85,7 @@ class RestStore(object):
 
         :return:
         """
-        for k in list(self.stores.keys()):
-            s = self.stores.get(k)
-            s.close()
+        self.host.close_all()
 
     #@app.route('/')
     def index(self):
@@ -64,6 +100,20 @@ class RestStore(object):
         """
         return json.dumps({'STORE REST API': {'version': 0.1}})
 
+    #@app.route('/metrics', methods=['GET'])
+    def metrics_text(self):
+        """
+
+        Metrics of the service and of the stores it hosts, in the Prometheus text format
+
+        URL: /metrics
+        METHOD: GET
+
+        :return: the metrics
+        """
+        ms = [self.metrics] + [s.metrics for s in [self.host.get(sid) for sid in self.host.keys()] if s is not None]
+        return Response(prometheus_text(ms), mimetype='text/plain; version=0.0.4')
+
     #@app.route('/create/<store_id>', methods=['POST'])
     def create(self, store_id):
         """
@@ -88,17 +138,28 @@ class RestStore(object):
         :return: JSON as described in init
         """
 
-        print('{}'.format(request.form))
         root = request.form.get('root')
         home = request.form.get('home')
         size = int(request.form.get('size', 0))
 
-        print('CREATE {} -> {} -> {} -> {}'.format(store_id, root, home, size))
+        self.logger.debug('CREATE {} -> {} -> {} -> {}'.format(store_id, root, home, size))
 
-        store = Store(store_id, root, home, size)
-        self.stores.update({store_id: (store, time.time())})
+        self.add_store(store_id, root, home, size)
         return json.dumps({'result': True, "data": None})
 
+    def add_store(self, store_id, root, home, size):
+        """
+
+        Create a store hosted by this service, if a store with the same id already exists it is kept
+
+        :param store_id: id of the store to be created
+        :param root: root of the store
+        :param home: home of the store
+        :param size: cache size of the store
+        :return: the store
+        """
+        return self.host.create(store_id, root, home, size, store_id + self.sid_suffix)
+
     #@app.route('/get/<store_id>/<path:uri>', methods=['GET'])
     def get(self, store_id, uri):
         """
@@ -109,6 +170,31 @@ class RestStore(object):
         METHOD: GET
 
 
+        For URIs containing wildcards the matching entries can be streamed as newline delimited JSON,
+        one {'key':string, 'value':string, 'version': int} object per line, by passing the parameter
+        stream=ndjson or by accepting application/x-ndjson. With local=true the entries are streamed
+        as they are read from the store, without resolving them. Otherwise the entries of the store
+        are followed by those of the other stores as their answers arrive, see Store.iterResolveAll,
+        a key is then repeated when a newer version of it arrives, its last line being the newest.
+
+        The entries can be filtered with where, a predicate on the JSON fields of the values, and
+        projected with select, the fields to return, both are evaluated by the stores answering
+        (see dstore.query).
+
+        eg. curl
+
+        curl --url 'http://127.0.0.1:5000/get/123/r/*?stream=ndjson&local=true'
+
+        curl --url 'http://127.0.0.1:5000/get/123/r/*?where=status%3Drun&select=status,entity_data.memory'
+
+        Typed values (see Store.put) are returned decoded, the raw ones base64 encoded, unless
+        raw=true is passed, in which case the encoded bytes of the value are returned as they are
+        with the name of the codec in the X-Dstore-Codec header.
+
+        Single-key gets accept consistency and min_version, see Store.get_with_version, an invalid
+        one is answered with a 400. The answer carries an ETag made of the version and a digest of
+        the content, a 304 is answered when it matches If-None-Match.
+
         :param store_id: id of the store to use
         :param uri: URI of the resource to retrieve
         :return: JSON as described in init
@@ -116,28 +202,184 @@ class RestStore(object):
 
         v = None
 
-        print('GET -> {}'.format(uri))
-        store = self.stores.get(store_id, None)
+        self.logger.debug('GET -> {}'.format(uri))
+        store = self.host.get(store_id)
         if store is None:
             return json.dumps({'result': False, "store_id": store_id, "data": [{'key': uri, 'value': None, 'version': None}]})
-        store = store[0]
+
+        where = request.args.get('where')
+        select = request.args.get('select')
+        if '*' in uri and (request.args.get('stream') == 'ndjson' or
+                           request.accept_mimetypes.best == 'application/x-ndjson'):
+            if request.args.get('local', 'false') == 'true':
+                xs = Query(where, select).filter(store.iterAll(uri))
+            else:
+                xs = store.iterResolveAll(uri, where, select)
+            return Response(self.__ndjson(xs), mimetype='application/x-ndjson')
 
         if '*' in uri:
-            v = store.resolveAll(uri)
+            v = store.resolveAll(uri, where, select)
         else:
-            v = store.get(uri)
-
-        print('V-> {}'.format(v))
-        if v is not None or len(v) == 0:
-            if isinstance(v, list):
-                data = []
-                for (key, val, ver) in v:
-                    data.append({'key': key, 'value': val, 'version':ver})
-                return json.dumps({'result': True, "store_id": store_id, 'data': data})
+            consistency = request.args.get('consistency', Store.CACHED_IF_NEWER_THAN)
+            if consistency not in self.CONSISTENCIES:
+                return self.__bad_request(store_id, uri, 'unknown consistency {}'.format(consistency))
+            min_version = request.args.get('min_version')
+            if min_version is not None:
+                try:
+                    min_version = int(min_version)
+                except ValueError:
+                    return self.__bad_request(store_id, uri, 'min_version must be an integer')
+            # the value is read as for any get, thus the freshness and the consistency are honored
+            (val, ver) = store.get_with_version(uri, consistency, min_version)
+            if isinstance(val, Value) and request.args.get('raw', 'false') == 'true':
+                r = Response(bytes(val.view()), mimetype='application/octet-stream', headers={'X-Dstore-Codec': val.codec})
             else:
-                return json.dumps({'result': True, "store_id": store_id, "data": [{'key': uri, 'value': v, 'version': None}]})
-        else:
-            return json.dumps({'result': True, "store_id": store_id, "data": [{'key': uri, 'value': None, 'version': None}]})
+                r = Response(json.dumps({'result': True, "store_id": store_id, "data": [{'key': uri, 'value': jsonable(val), 'version': ver}]}))
+            if ver is not None:
+                # versions restart when a key is removed and put again, thus the tag also covers the content
+                etag = '{}-{}'.format(ver, hashlib.sha1(r.get_data()).hexdigest()[:16])
+                if request.if_none_match.contains(etag):
+                    r = Response(status=304)
+                r.set_etag(etag)
+            return r
+
+        self.logger.debug('V-> {}'.format(v))
+        data = []
+        if v is not None:
+            for (key, val, ver) in v:
+                data.append({'key': key, 'value': jsonable(val), 'version':ver})
+        return json.dumps({'result': True, "store_id": store_id, 'data': data})
+
+    def __bad_request(self, store_id, uri, reason):
+        self.logger.debug('Bad request on {}: {}'.format(uri, reason))
+        return Response(json.dumps({'result': False, "store_id": store_id, "data": [{'key': uri, 'value': None, 'version': None}],
+                                    'error': reason}), status=400)
+
+    #@app.route('/watch/<store_id>/<path:uri>', methods=['GET'])
+    def watch(self, store_id, uri):
+        """
+
+        Watch the changes of the resources matching an URI as server-sent events
+
+        URL: /watch/<store_id>/<path:uri>
+        METHOD: GET
+
+        Each change is sent as an event of type put or remove whose data is
+        {'key':string, 'value':string, 'version': int}
+
+        eg. curl
+
+        curl --no-buffer --url 'http://127.0.0.1:5000/watch/123/r/h/*'
+
+        :param store_id: id of the store to use
+        :param uri: URI of the resources to watch, can contain wildcards
+        :return: an event stream
+        """
+
+        store = self.host.get(store_id)
+        if store is None:
+            return json.dumps({'result': False, "store_id": store_id, "data": None})
+
+        events = queue.Queue(self.watch_queue_size)
+
+        def action(key, value, version):
+            # The observer runs on the thread changing the store, it must never block
+            while True:
+                try:
+                    events.put_nowait((key, value, version))
+                    return
+                except queue.Full:
+                    try:
+                        events.get_nowait()
+                    except queue.Empty:
+                        pass
+
+        def stream():
+            try:
+                while True:
+                    try:
+                        (key, value, version) = events.get(timeout=self.keepalive)
+                    except queue.Empty:
+                        yield ': keepalive\n\n'
+                        continue
+                    kind = 'remove' if value is None and version is None else 'put'
+                    yield 'event: {}\ndata: {}\n\n'.format(kind, json.dumps({'key': key, 'value': jsonable(value), 'version': version}))
+            finally:
+                store.unobserve(uri, action)
+
+        store.observe(uri, action)
+        return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+    def __ndjson(self, xs):
+        for (key, val, ver) in xs:
+            yield json.dumps({'key': key, 'value': jsonable(val), 'version': ver}) + '\n'
+
+    #@app.route('/mget/<store_id>', methods=['POST'])
+    def mget(self, store_id):
+        """
+
+        Get many keys from a store in a single request
+
+        URL: /mget/<store_id>
+        METHOD: POST
+
+        The keys should be passed as a JSON list in the request body, the keys missing from the
+        store are resolved concurrently, see Store.mget
+
+        eg. curl
+
+        curl --request POST \
+            --url http://127.0.0.1:5000/mget/123 \
+            --header 'Content-Type: application/json' \
+            --data '["r/h/a", "r/h/b"]'
+
+        :param store_id: id of the store to use
+        :return: JSON as described in init
+        """
+
+        keys = request.get_json(force=True, silent=True)
+        store = self.host.get(store_id)
+        if store is None or not isinstance(keys, list):
+            return json.dumps({'result': False, "store_id": store_id, "data": None})
+
+        data = []
+        for (k, (val, ver)) in zip(keys, store.mget(keys)):
+            data.append({'key': k, 'value': jsonable(val), 'version': ver})
+        return json.dumps({'result': True, "store_id": store_id, 'data': data})
+
+    #@app.route('/scan/<store_id>/<path:prefix>', methods=['GET'])
+    def scan(self, store_id, prefix=''):
+        """
+
+        Get a page of the entries of a store whose key starts with a prefix, in key order
+
+        URL: /scan/<store_id>/<path:prefix>
+        METHOD: GET
+
+        At most limit entries (default 512) are returned, after the key given by start_after if any.
+        The answer has 'next', the start_after of the next page, which is null after the last page.
+
+        eg. curl
+
+        curl --url 'http://127.0.0.1:5000/scan/123/r/h/?limit=100&start_after=r/h/a'
+
+        :param store_id: id of the store to use
+        :param prefix: prefix of the keys
+        :return: JSON as described in init plus 'next'
+        """
+
+        store = self.host.get(store_id)
+        try:
+            limit = int(request.args.get('limit', 512))
+        except ValueError:
+            limit = None
+        if store is None or limit is None:
+            return json.dumps({'result': False, "store_id": store_id, "data": None, 'next': None})
+
+        vs = store.scan(prefix, request.args.get('start_after'), limit)
+        data = [{'key': k, 'value': jsonable(v), 'version': ver} for (k, v, ver) in vs]
+        nxt = vs[-1][0] if len(vs) > 0 and len(vs) == limit else None
+        return json.dumps({'result': True, "store_id": store_id, 'data': data, 'next': nxt})
 
     #@app.route('/put/<store_id>/<path:uri>', methods=['PUT'])
     def put(self, store_id, uri):
@@ -150,27 +392,100 @@ class RestStore(object):
 
         The value should be passed inside the request body under key 'value'
 
+        With the parameter codec the value is stored as a typed value: with codec=raw the request
+        body is the value, with codec=json or codec=msgpack the value is given as JSON text
+
         example using curl
 
         curl --request PUT \
             --url http://127.0.0.1:5000/put/yaks://some/key \
             --form 'value: key value'
 
+        curl --request PUT \
+            --url 'http://127.0.0.1:5000/put/yaks://some/key?codec=raw' \
+            --data-binary @image.png
+
         :param store_id: id of the store to use
         :param uri: URI of the resource to put
         :return: JSON as described in init
         """
 
-        value = request.form.get('value')
-        print('PUT -> {} -> {}'.format(uri, value))
+        codec = request.args.get('codec')
+        if codec == 'raw':
+            value = request.get_data()
+        else:
+            value = request.form.get('value')
+        self.logger.debug('PUT -> {} -> {}'.format(uri, value))
 
-        store = self.stores.get(store_id, None)
+        store = self.host.get(store_id)
         if store is None:
             return json.dumps({'result': False, "store_id": store_id, "data": None})
-        store = store[0]
 
-        version = store.put(uri, value)
-        return json.dumps({'result': True, "store_id": store_id, "data": [{'key': uri, 'value': value, 'version': version}]})
+        try:
+            if codec is not None and codec != 'raw' and value is not None:
+                value = json.loads(value)
+            version = store.put(uri, value, codec)
+        except ValueError:
+            return json.dumps({'result': False, "store_id": store_id, "data": None})
+        return json.dumps({'result': True, "store_id": store_id, "data": [{'key': uri, 'value': jsonable(value), 'version': version}]})
+
+    #@app.route('/mput/<store_id>', methods=['PUT'])
+    def mput(self, store_id):
+        """
+
+        PUT many values inside a store in a single request
+
+        URL: /mput/<store_id>
+        METHOD: PUT
+
+        The entries should be passed as a JSON list in the request body
+
+        With the parameter codec the values are stored as typed values, see put: the values of the
+        json and msgpack codecs are given as JSON, the raw ones base64 encoded
+
+        All the entries are checked and encoded before the first put, an invalid key or value is
+        answered with a 400 and nothing is put
+
+        eg. curl
+
+        curl --request PUT \
+            --url http://127.0.0.1:5000/mput/123 \
+            --header 'Content-Type: application/json' \
+            --data '[{"key": "r/h/a", "value": "1"}, {"key": "r/h/b", "value": "2"}]'
+
+        :param store_id: id of the store to use
+        :return: JSON as described in init
+        """
+
+        codec = request.args.get('codec')
+        entries = request.get_json(force=True, silent=True)
+        store = self.host.get(store_id)
+        if store is None or not isinstance(entries, list) or not all(isinstance(e, dict) for e in entries):
+            return json.dumps({'result': False, "store_id": store_id, "data": None})
+
+        try:
+            # the entries are all checked and encoded first, so that nothing is put when one is invalid
+            xs = []
+            for e in entries:
+                if not isinstance(e.get('key'), str):
+                    raise ValueError('invalid key {}'.format(e.get('key')))
+                v = self.__entry_value(e.get('value'), codec)
+                xs.append((e.get('key'), Value.encode(codec, v) if codec is not None else v))
+        except (ValueError, TypeError, AttributeError) as e:
+            self.logger.debug('Bad mput on {}: {}'.format(store_id, e))
+            return Response(json.dumps({'result': False, "store_id": store_id, "data": None, 'error': str(e)}), status=400)
+        data = []
+        for (k, v) in xs:
+            data.append({'key': k, 'value': jsonable(v), 'version': store.put(k, v)})
+        return json.dumps({'result': True, "store_id": store_id, 'data': data})
+
+    def __entry_value(self, value, codec):
+        # typed values are given decoded, the raw ones base64 encoded
+        if codec == 'raw' and isinstance(value, str):
+            return base64.b64decode(value, validate=True)
+        if codec is None and value is not None and not isinstance(value, str):
+            return json.dumps(value)
+        return value
 
     #@app.route('/dput/<store_id>/<path:uri>/', methods=['PATCH'])
     def dput(self, store_id, uri):
@@ -183,6 +498,9 @@ class RestStore(object):
 
         WARNING: this works only if value are JSON object
 
+        With the parameter codec a key without value gets a typed value, see put, the typed values
+        keep their codec
+
          The value should be passed inside the request body under key 'value'
 
         example using curl
@@ -199,12 +517,14 @@ class RestStore(object):
 
         value = request.form.get('value')
 
-        store = self.stores.get(store_id, None)
+        store = self.host.get(store_id)
         if store is None:
             return json.dumps({'result': False, "store_id": store_id, "data": None})
-        store = store[0]
 
-        version = store.dput(uri, value)
+        try:
+            version = store.dput(uri, value, request.args.get('codec'))
+        except ValueError:
+            return json.dumps({'result': False, "store_id": store_id, "data": None})
         return json.dumps({'result': True, "store_id": store_id, "data": [{'key': uri, 'value': value, 'version': version}]})
 
     #@app.route('/remove/<store_id>/<path:uri>', methods=['DELETE'])
@@ -222,15 +542,12 @@ class RestStore(object):
         """
 
 
-        store = self.stores.get(store_id, None)
+        store = self.host.get(store_id)
         if store is None:
             return json.dumps({'result': False, "store_id": store_id, "data": None})
-        store = store[0]
 
-        if store.remove(uri):
-            return json.dumps({'result': True, "store_id": store_id, "data": [{'key': uri, 'value': None, 'version': None}]})
-        else:
-            return json.dumps({'result': False, "store_id": store_id, "data": [{'key': uri, 'value': None, 'version': None}]})
+        store.remove(uri)
+        return json.dumps({'result': True, "store_id": store_id, "data": [{'key': uri, 'value': None, 'version': None}]})
 
     #@app.route('/destroy/<store_id>', methods=['DELETE'])
     def destroy(self, store_id):
@@ -246,12 +563,10 @@ class RestStore(object):
         """
 
 
-        store = self.stores.get(store_id, None)
+        store = self.host.get(store_id)
         if store is None:
             return json.dumps({'result': False, "store_id": store_id, "data": None})
-        store = store[0]
-        store.close()
-        self.stores.pop(store_id)
+        self.host.close(store_id)
         return json.dumps({'result': True, "store_id": store_id, "data": None})
 
     def stop(self):
@@ -273,17 +588,51 @@ class RestStore(object):
 
         Start the service
 
-        This is used in dstore-rest-server
+        This is used in dstore-rest-server, it runs the Werkzeug development server in a single process,
+        requests are served concurrently by a thread each. For production deployments use the application
+        returned by create_app with a WSGI server.
 
         :return:
         """
 
         try:
-            self.app.run(debug=True, host=self.address, port=self.port)
+            self.app.run(debug=False, use_reloader=False, threaded=True, host=self.address, port=self.port)
         finally:
             self.__close_all_store()
 
 
+def create_app(stores=None):
+    """
+
+    WSGI application factory, each process running the application hosts its own RestStore
+
+    eg. gunicorn --workers 4 --bind 0.0.0.0:5000 'dstore.rest_store:create_app()'
+
+    As every worker is a separate process, the stores that have to be reachable through any worker
+    should be created at startup, either through the stores parameter or through the DSTORE_STORES
+    environment variable, formatted as 'sid,root,home,size;sid,root,home,size;...'
+
+    The stores of each worker join their root as <sid>-<pid>, thus the workers are distinct peers
+    that exchange their updates and resolve each other's misses as any other stores, while clients
+    keep using <sid> in the URLs. The application has to be created in each worker, i.e. without
+    the --preload option of gunicorn, which would share the stores of the master process.
+
+    :param stores: list of (store_id, root, home, size) of the stores to create at startup
+    :return: the WSGI application
+    """
+    if stores is None:
+        stores = []
+        for s in os.environ.get('DSTORE_STORES', '').split(';'):
+            xs = s.split(',')
+            if len(xs) == 4:
+                stores.append((xs[0], xs[1], xs[2], int(xs[3])))
+
+    rs = RestStore(sid_suffix='-{}'.format(os.getpid()))
+    for (store_id, root, home, size) in stores:
+        rs.add_store(store_id, root, home, size)
+    return rs.app
+
+
 
 
 
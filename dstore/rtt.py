@@ -0,0 +1,88 @@
+import threading
+
+
+class RttEstimator(object):
+    """Smoothed round trip time of a single peer, as computed by TCP (RFC 6298).
+
+    The retransmission timeout is srtt + 4 * rttvar, bounded by *min_rto* and *max_rto*.
+    """
+
+    ALPHA = 1.0 / 8
+    BETA = 1.0 / 4
+
+    def __init__(self, initial_rto, min_rto, max_rto):
+        self.srtt = None
+        self.rttvar = None
+        self.samples = 0
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.rto = initial_rto
+
+    def sample(self, rtt):
+        """Updates the estimates with a new measure
+
+        :param rtt: the measured round trip time in seconds
+        """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self.samples += 1
+        self.rto = min(max(self.srtt + 4 * self.rttvar, self.min_rto), self.max_rto)
+
+
+class RttTable(object):
+    """Keeps the round trip time estimates of the peers of a store.
+
+    Peers that never answered are given *initial_rto*.
+    """
+
+    def __init__(self, initial_rto=0.25, min_rto=0.005, max_rto=5.0):
+        """
+        :param initial_rto: the timeout used for the peers without measures, in seconds
+        :param min_rto: the lower bound of the timeouts
+        :param max_rto: the upper bound of the timeouts
+        """
+        self.initial_rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.__peers = {}
+        self.__lock = threading.Lock()
+
+    def sample(self, sid, rtt):
+        """Records the round trip time of a request answered by a peer
+
+        :param sid: the store id of the peer
+        :param rtt: the time elapsed between the request and the answer, in seconds
+        """
+        with self.__lock:
+            e = self.__peers.get(sid)
+            if e is None:
+                e = RttEstimator(self.initial_rto, self.min_rto, self.max_rto)
+                self.__peers[sid] = e
+            e.sample(rtt)
+
+    def remove(self, sid):
+        with self.__lock:
+            self.__peers.pop(sid, None)
+
+    def rto(self, sids):
+        """
+        :param sids: the store ids of the peers expected to answer
+        :return: the time to wait for the answers of all the given peers before retransmitting
+        """
+        with self.__lock:
+            xs = [self.__peers[sid].rto if sid in self.__peers else self.initial_rto for sid in sids]
+        if len(xs) == 0:
+            return self.initial_rto
+        return max(xs)
+
+    def status(self):
+        """
+        :return: a dictionary mapping the store id of each peer to its srtt, rttvar and rto
+        """
+        with self.__lock:
+            return dict((sid, {'srtt': e.srtt, 'rttvar': e.rttvar, 'rto': e.rto, 'samples': e.samples})
+                        for (sid, e) in self.__peers.items())
@@ -0,0 +1,196 @@
+import bisect
+import fnmatch
+import json
+import mmap
+import os
+import struct
+from .codec import Value, codec_by_id, get_codec
+from .index import literal_prefix
+
+# Layout of a snapshot file, all integers are little endian:
+#
+#    header:  magic (8 bytes) | count (u64) | index offset (u64)
+#    data:    the keys and the values, UTF-8 encoded or encoded by their codec, one after the other
+#    index:   count records sorted by key, each one made of
+#             key offset (u64) | key length (u32) | value offset (u64) | value length (u32) | version (i64) | value type (u8)
+#
+# The index is searched in place, thus opening a snapshot reads nothing but the header.
+
+MAGIC = b'DSNAP001'
+HEADER = struct.Struct('<8sQQ')
+RECORD = struct.Struct('<QIQIqB')
+
+# Types of the values
+STR = 0
+BYTES = 1
+NONE = 2
+JSON = 3
+TYPED = 16  # values encoded by a codec, the type is TYPED + the id of the codec
+
+
+def encode_value(v):
+    if isinstance(v, Value):
+        return (TYPED + get_codec(v.codec).id, v.data)
+    if v is None:
+        return (NONE, b'')
+    if isinstance(v, str):
+        return (STR, v.encode('utf-8'))
+    if isinstance(v, bytes):
+        return (BYTES, v)
+    return (JSON, json.dumps(v).encode('utf-8'))
+
+
+def decode_value(t, b):
+    if t >= TYPED:
+        return Value(codec_by_id(t - TYPED).name, bytes(b))
+    if t == STR:
+        return str(b, 'utf-8')
+    if t == BYTES:
+        return bytes(b)
+    if t == NONE:
+        return None
+    return json.loads(str(b, 'utf-8'))
+
+
+def write_snapshot(path, entries):
+    """Writes a snapshot, the file is replaced atomically
+
+    :param path: the file
+    :param entries: an iterable of (key, value, version)
+    :return: the number of entries written
+    """
+    xs = sorted(((k.encode('utf-8'), v, ve) for (k, v, ve) in entries), key=lambda x: x[0])
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, 0, 0))
+        off = HEADER.size
+        records = []
+        for (k, v, ve) in xs:
+            (t, b) = encode_value(v)
+            f.write(k)
+            f.write(b)
+            records.append(RECORD.pack(off, len(k), off + len(k), len(b), ve if ve is not None else -1, t))
+            off += len(k) + len(b)
+        for r in records:
+            f.write(r)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, len(records), off))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return len(records)
+
+
+class Snapshot(object):
+    """A read-only snapshot of the entries of a store, mapped in memory.
+
+    Keys are looked up by binary search on the index of the file and values are decoded on
+    access, view returns the encoded value without copying it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.__f = open(path, 'rb')
+        size = os.fstat(self.__f.fileno()).st_size
+        if size < HEADER.size:
+            self.__f.close()
+            raise ValueError('{} is not a store snapshot'.format(path))
+        self.__mm = mmap.mmap(self.__f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.count, self.__index) = HEADER.unpack_from(self.__mm, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError('{} is not a store snapshot'.format(path))
+        self.__keys = SnapshotKeys(self)
+
+    def __len__(self):
+        return self.count
+
+    def record(self, i):
+        return RECORD.unpack_from(self.__mm, self.__index + i * RECORD.size)
+
+    def key(self, i):
+        (ko, kl, _, _, _, _) = self.record(i)
+        return str(self.__mm[ko:ko + kl], 'utf-8')
+
+    def find(self, uri):
+        """
+        :return: the position of the key in the index, None if the key is not in the snapshot
+        """
+        i = bisect.bisect_left(self.__keys, uri)
+        if i < self.count and self.key(i) == uri:
+            return i
+        return None
+
+    def get(self, uri):
+        """
+        :return: the tuple (value, version), None if the key is not in the snapshot
+        """
+        i = self.find(uri)
+        if i is None:
+            return None
+        (_, _, vo, vl, ve, t) = self.record(i)
+        return (decode_value(t, self.__mm[vo:vo + vl]), ve)
+
+    def view(self, uri):
+        """
+        :return: the memoryview of the encoded value of a key, None if the key is not in the snapshot
+        """
+        i = self.find(uri)
+        if i is None:
+            return None
+        (_, _, vo, vl, _, _) = self.record(i)
+        return memoryview(self.__mm)[vo:vo + vl]
+
+    def items(self, pattern='*'):
+        """
+        :param pattern: a pattern with wildcards, only the part of the index sharing its literal prefix is scanned
+        :return: an iterator of (key, value, version) in key order
+        """
+        prefix = literal_prefix(pattern)
+        i = bisect.bisect_left(self.__keys, prefix)
+        while i < self.count:
+            (ko, kl, vo, vl, ve, t) = self.record(i)
+            k = str(self.__mm[ko:ko + kl], 'utf-8')
+            if not k.startswith(prefix):
+                break
+            if fnmatch.fnmatch(k, pattern):
+                yield (k, decode_value(t, self.__mm[vo:vo + vl]), ve)
+            i += 1
+
+    def keys(self, prefix='', start_after=None):
+        """
+        :param prefix: if given, only the keys starting with it are returned
+        :param start_after: if given, only the keys greater than it are returned
+        :return: an iterator of the keys in order
+        """
+        if start_after is not None and start_after >= prefix:
+            i = bisect.bisect_right(self.__keys, start_after)
+        else:
+            i = bisect.bisect_left(self.__keys, prefix)
+        while i < self.count:
+            k = self.key(i)
+            if not k.startswith(prefix):
+                break
+            yield k
+            i += 1
+
+    def close(self):
+        try:
+            self.__mm.close()
+        except BufferError:
+            # views on the values are still alive, the mapping is released with them
+            pass
+        self.__f.close()
+
+
+class SnapshotKeys(object):
+    """The sorted keys of a snapshot as a sequence, for bisect"""
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __len__(self):
+        return len(self.snapshot)
+
+    def __getitem__(self, i):
+        return self.snapshot.key(i)
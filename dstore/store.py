@@ -1,13 +1,33 @@
 import fnmatch
+import heapq
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from .abstract_store import AbstractStore
 from .controller import StoreController
+from .metrics import Metrics
+from .tracing import Tracer
+from .table import CompactTable
+from .snapshot import Snapshot, write_snapshot
+from .index import IndexedDict, literal_prefix
+from .query import Query
+from .aggregate import Aggregate
+from .codec import Value
 import time
 
 class Store(AbstractStore):
     """This class provides the API to interact with the distributed store."""
 
-    def __init__(self, store_id, root, home, cache_size):
+    # Consistency levels of get_with_version
+    LOCAL = 'local'
+    CACHED_IF_NEWER_THAN = 'cached_if_newer_than'
+    QUORUM = 'quorum'
+
+    # Maximum number of the misses of mget resolved at once
+    MGET_WORKERS = 16
+
+    def __init__(self, store_id, root, home, cache_size, lease_duration=0, eager_cache=True, shard_depth=0,
+                 trace_sample_rate=0.0, trace_file=None, compact=False):
         """Creates a new store.
 
         :param store_id: the string representing the global store identifier.
@@ -17,26 +37,71 @@ class Store(AbstractStore):
                      prefix are kept in memory.
         :param cache_size: the size of the cache that will be holding keys that
                            have the root as a prefix but not the home.
+        :param lease_duration: the duration in seconds of the leases granted to the stores caching
+                               keys under *home*, 0 if no lease is granted. While a lease holds,
+                               the cached value is served without remote resolution.
+        :param eager_cache: if True every update published under *root* is cached, otherwise only
+                            the updates of the keys this store is interested in are processed, that
+                            is keys under *home*, already cached keys, observed keys and the keys
+                            matching the patterns given to declare_interest.
+        :param shard_depth: the updates are published on a partition made of the root and the first
+                            *shard_depth* segments of the key below the root, and the store subscribes
+                            only to the partitions overlapping its home and its interests. All the
+                            stores sharing a root must use the same depth, 0 means a single partition.
+        :param trace_sample_rate: the fraction of the updates of this store that are traced to the
+                                  observers of the other stores, see tracing.Tracer.
+        :param trace_file: if given, the trace events seen by this store are appended to this file
+                           as JSON lines.
+        :param compact: if True the entries are kept in CompactTable tables, which need less memory
+                        for large keyspaces with long shared prefixes at the price of slower accesses.
         """
         super(Store, self).__init__()
         self.root = root
         self.home = home
         self.store_id = store_id
-        self.__store = {}  # This stores URI whose prefix is **home**
+        self.lease_duration = lease_duration
+        self.__leases = {}  # expiration time of the leases on the cached URI
+        self.eager_cache = eager_cache
+        self.shard_depth = shard_depth
+        self.__interests = set()
+        # both tables can scan their keys in order
+        table = CompactTable if compact else IndexedDict
+        self.__store = table()  # This stores URI whose prefix is **home**
         self.discovered_stores = {}  # list of discovered stores not including self
+        self.__discovery = threading.Condition()
         self.__cache_size = cache_size
-        self.__local_cache = {}  # this is a cache that stores up
+        self.__local_cache = table()  # this is a cache that stores up
         # to __cache_size entry for URI whose prefix is not **home**
         self.__observers = {}
+        self.__snapshot = None  # entries loaded from a snapshot, superseded by the tables
+        self.__snapshot_removed = set()  # keys of the snapshot removed since it was loaded
+        self.metrics = Metrics(store=store_id)
+        self.__m_puts = self.metrics.counter('puts_total', 'Values written by this store')
+        self.__m_gets = self.metrics.counter('gets_total', 'Values read from this store')
+        self.__m_hits = self.metrics.counter('get_hits_total', 'Reads served by the values held by this store')
+        self.__m_misses = self.metrics.counter('get_misses_total', 'Reads that required a remote resolution')
+        self.__m_resolve = self.metrics.histogram('resolve_seconds', 'Latency of the resolutions of a key')
+        self.__m_resolve_all = self.metrics.histogram('resolve_all_seconds', 'Latency of the resolutions of a pattern')
+        self.__m_notify = self.metrics.histogram('observer_dispatch_seconds', 'Time spent in the observers')
+        self.metrics.gauge('stored_keys', lambda: len(self.__store), 'Keys under home held by this store')
+        self.metrics.gauge('cached_keys', lambda: len(self.__local_cache), 'Keys cached by this store')
+        self.metrics.gauge('observers', lambda: sum(len(xs) for xs in list(self.__observers.values())), 'Registered observers')
+        self.metrics.gauge('peers', lambda: len(self.discovered_stores), 'Known stores sharing the root')
+        self.tracer = Tracer(store_id, self.metrics, trace_sample_rate)
+        if trace_file is not None:
+            self.tracer.export_spans(trace_file)
         self.__controller = StoreController(self)
         self.__controller.start()
         self.logger = self.__controller.logger
 
         self.__metaresources = {}
+        self.__aggregates = {}
 
         self.register_metaresource('keys', self.__get_keys_under)
         self.register_metaresource('stores', self.__get_stores)
-        time.sleep(2)
+        self.register_metaresource('metrics', self.__get_metrics)
+        self.register_metaresource('profile', self.__get_profile)
+        self.register_metaresource('aggregates', self.__get_aggregates)
 
 
     def keys(self):
@@ -44,7 +109,7 @@ class Store(AbstractStore):
 
         :return: List of string
         """
-        return list(self.__store.keys())
+        return list(self.__scan_keys('', None, False))
 
     def is_stored_value(self, uri):
         if uri.startswith(self.home):
@@ -59,11 +124,11 @@ class Store(AbstractStore):
         version = None
         v = None
         if self.is_stored_value(uri):
-            if uri in self.__store:
-                v = self.__store[uri]
+            v = self.__store.get(uri)
         else:
-            if uri in self.__local_cache:
-                v = self.__local_cache[uri]
+            v = self.__local_cache.get(uri)
+        if v is None:
+            v = self.__snapshot_value(uri)
 
         if v is not None:
             version = v[1]
@@ -73,13 +138,100 @@ class Store(AbstractStore):
     def get_value(self, uri):
         v = None
 
-        if uri in self.__store.keys():
-            v = self.__store[uri]
-        elif uri in self.__local_cache.keys():
-            v = self.__local_cache[uri]
+        v = self.__store.get(uri)
+        if v is None:
+            v = self.__local_cache.get(uri)
+        if v is None:
+            v = self.__snapshot_value(uri)
 
         return v
 
+    def view(self, uri):
+        '''
+
+        Gives access to the encoded bytes of a typed value, or of a value of the loaded snapshot,
+        without copying them. The value is not resolved.
+
+        :param uri: the key
+        :return: a memoryview, None if the key has no value or its value is not typed
+        '''
+        v = self.__store.get(uri)
+        if v is None:
+            v = self.__local_cache.get(uri)
+        if v is not None:
+            return v[0].view() if isinstance(v[0], Value) else None
+        sn = self.__snapshot
+        if sn is None or uri in self.__snapshot_removed:
+            return None
+        return sn.view(uri)
+
+    def __snapshot_value(self, uri):
+        sn = self.__snapshot
+        if sn is None or uri in self.__snapshot_removed:
+            return None
+        return sn.get(uri)
+
+    def renew_lease(self, uri, lease):
+        """Records a lease granted by the home store of a cached URI, without lease the value
+        does not expire any more, as the one of a home store that does not grant leases
+
+        :param uri: the cached URI
+        :param lease: the duration of the lease in seconds, 0 or None if no lease was granted
+        """
+        if not self.is_cached_value(uri):
+            return
+        if lease is not None and lease > 0:
+            self.__leases[uri] = time.time() + lease
+        else:
+            self.__leases.pop(uri, None)
+
+    def is_fresh(self, uri):
+        """Checks if a cached value can be served without remote resolution, that is
+        the value is under the home of this store, or the lease on the value has not expired,
+        or no lease was ever granted on the value.
+
+        :param uri: the URI
+        :return: True if the value can be served from the cache
+        """
+        if uri not in self.__leases:
+            return True
+        return self.__leases.get(uri, 0) > time.time()
+
+    def declare_interest(self, uri):
+        """Declares the interest of this store for the updates of the keys matching the URI,
+        this matters only for stores that do not cache eagerly.
+
+        :param uri: the URI, can contain wildcards
+        """
+        self.__interests.add(uri)
+        self.__controller.subscribe(uri)
+
+    def withdraw_interest(self, uri):
+        """Withdraws an interest declared with declare_interest
+
+        :param uri: the URI given to declare_interest
+        """
+        self.__interests.discard(uri)
+
+    def get_interests(self):
+        """
+        :return: the patterns of the keys this store is interested in, in addition to its home
+        """
+        return list(self.__interests) + list(self.__observers.keys())
+
+    def is_interested(self, uri):
+        """Checks if the updates of a key have to be processed by this store
+
+        :param uri: the key
+        :return: True if the updates have to be processed
+        """
+        if self.eager_cache or uri.startswith(self.home) or uri in self.__local_cache:
+            return True
+        for p in self.get_interests():
+            if fnmatch.fnmatch(uri, p):
+                return True
+        return False
+
     def next_version(self, uri):
         nv = 0
         v = self.get_version(uri)
@@ -114,6 +266,8 @@ class Store(AbstractStore):
             self.__unchecked_store_value(uri, value, version)
             succeeded = True
 
+        if succeeded:
+            self.tracer.event('update', uri, version)
         return succeeded
 
     def notify_observers(self, uri, value, v):
@@ -134,13 +288,21 @@ class Store(AbstractStore):
             if fnmatch.fnmatch(uri, key) or fnmatch.fnmatch(key, uri):
                 #print('Store', ">>>>>>>> notify_observers inside if")
                 self.logger.debug('Store', ">>>>>>>> notify_observers inside if")
-                self.__observers.get(key)(uri, value, v)
+                for action in list(self.__observers.get(key, [])):
+                    t = time.time()
+                    action(uri, value, v)
+                    self.__m_notify.observe(time.time() - t)
+        self.tracer.event('notify', uri, v)
 
-    def put(self, uri, value):
+    def put(self, uri, value, codec=None):
         '''Store the  **<key, value>** tuple on the distributed store.
 
+        When a codec is given the value is encoded once and stored, published and resolved as
+        a dstore.codec.Value holding the encoded bytes, see view.
+
         :param uri: key
         :param value: value
+        :param codec: if given, the codec of the value or its name: raw, json or msgpack
         :return: the version
         '''
 
@@ -148,26 +310,33 @@ class Store(AbstractStore):
             self.logger.debug('Store', 'No writing right for URI {0}'.format(type(uri)))
             return None
 
+        if codec is not None:
+            value = Value.encode(codec, value)
+
+        self.__m_puts.inc()
         v = self.get_version(uri)
         if v == None:
             v = 0
         else:
             v = v + 1
-        self.update_value(uri, value, v)
-
-        # It is always the observer that inserts data in the cache
-        self.__controller.onPut(uri, value, v)
-        ##print("notify_observers in put")
-        self.notify_observers(uri, value, v)
+        with self.tracer.activate(self.tracer.start()):
+            self.tracer.event('put', uri, v)
+            self.update_value(uri, value, v)
+
+            # It is always the observer that inserts data in the cache
+            self.__controller.onPut(uri, value, v)
+            ##print("notify_observers in put")
+            self.notify_observers(uri, value, v)
         return v
 
-    def pput(self, uri, value):
+    def pput(self, uri, value, codec=None):
         '''Persistently store the  **<key, value>** tuple on the distributed store.
            This operation requires a DDS durability service in order to really
            store data persistently.
 
         :param uri: key
         :param value: value
+        :param codec: if given, the codec of the value or its name, see put
         :return: the version
         '''
 
@@ -175,25 +344,36 @@ class Store(AbstractStore):
             self.logger.debug('Store', 'No writing right for URI {0}'.format(type(uri)))
             return None
 
+        if codec is not None:
+            value = Value.encode(codec, value)
+
+        self.__m_puts.inc()
         v = self.next_version(uri)
-        self.__unchecked_store_value(uri, value, v)
-        self.__controller.onPput(uri, value, v)
-        ##print("notify_observers in pput")
-        self.notify_observers(uri, value, v)
+        with self.tracer.activate(self.tracer.start()):
+            self.tracer.event('put', uri, v)
+            self.__unchecked_store_value(uri, value, v)
+            self.__controller.onPput(uri, value, v)
+            ##print("notify_observers in pput")
+            self.notify_observers(uri, value, v)
 
     def conflict_handler(self, action):
         pass
 
-    def dput(self, uri, values=None):
+    def dput(self, uri, values=None, codec=None):
         '''
 
         Same as put but for delta updates, fields to be update can be part of the uri after an hashtag eg. /root/home/key#value3=newvalue
 
         WARNING: this works only if values are dictionary/json data structures
 
+        The update is merged into the decoded value, which is then encoded again with the codec
+        of the current value, thus dput works the same on JSON text and on typed values.
+
         :param uri: the uri rapresenting the resource, can contain delta updates
-        :param values: the delta update value can be none
+        :param values: the delta update value can be none, either JSON text or a dictionary
+        :param codec: if given, the codec of the value when the key has no value yet
         :return: the new version
+        :raises ValueError: if the current value cannot be merged, e.g. a raw value
         '''
 
         if not self.__check_writing_rights(uri):
@@ -212,7 +392,14 @@ class Store(AbstractStore):
         self.logger.debug('Store', '>>> dput resolved {0} to {1}'.format(uri, data))
         self.logger.debug('Store', '>>> dput resolved type is {0}'.format(type(data)))
         version = 0
-        if data is None or data == '':
+        if isinstance(data, Value):
+            codec = data.codec
+            data = data.decode()
+            if not isinstance(data, (dict, list, str, int, float)) and data is not None:
+                # e.g. the bytes of a raw value, the update would be ignored
+                raise ValueError('The value of {} cannot be delta updated'.format(uri))
+            version = self.next_version(uri)
+        elif data is None or data == '':
             data = {}
         else:
             data = json.loads(data)
@@ -256,17 +443,23 @@ class Store(AbstractStore):
                 self.logger.debug('Store', '>>>merged data  {0} '.format(data))
         else:
             # #print('{0} type {1}'.format(values,type(values)))
-            jvalues = json.loads(values)
+            jvalues = json.loads(values) if isinstance(values, str) else values
             self.logger.debug('Store', 'dput delta value = {0}, data = {1}'.format(jvalues, data))
             data = self.data_merge(data, jvalues)
 
         self.logger.debug('Store', 'dput merged data = {0}'.format(data))
 
-        value = json.dumps(data)
-        self.__unchecked_store_value(uri, value, version)
-        self.__controller.onDput(uri, value, version)
-        ##print("notify_observers in dput")
-        self.notify_observers(uri, value, version)
+        if codec is not None:
+            value = Value.encode(codec, data)
+        else:
+            value = json.dumps(data)
+        self.__m_puts.inc()
+        with self.tracer.activate(self.tracer.start()):
+            self.tracer.event('put', uri, version)
+            self.__unchecked_store_value(uri, value, version)
+            self.__controller.onDput(uri, value, version)
+            ##print("notify_observers in dput")
+            self.notify_observers(uri, value, version)
         return version
 
     def observe(self, uri, action):
@@ -276,11 +469,29 @@ class Store(AbstractStore):
 
         action has to take 3 parametes (uri, value, version)
 
+        Several actions can observe the same uri.
+
         :param uri: the uri to observe
         :param action: the function to notify
         :return: None
         '''
-        self.__observers.update({uri: action})
+        self.__observers.update({uri: self.__observers.get(uri, []) + [action]})
+        self.__controller.onObserve(uri, action)
+
+    def unobserve(self, uri, action):
+        '''
+
+        Unregister an observer previously registered with observe
+
+        :param uri: the observed uri
+        :param action: the function that was notified
+        :return: None
+        '''
+        xs = [a for a in self.__observers.get(uri, []) if a != action]
+        if len(xs) > 0:
+            self.__observers.update({uri: xs})
+        elif uri in self.__observers:
+            self.__observers.pop(uri)
 
     def remove(self, uri):
         '''
@@ -295,10 +506,12 @@ class Store(AbstractStore):
             return None
 
         self.__controller.onRemove(uri)
-        if uri in list(self.__local_cache.keys()):
-            self.__local_cache.pop(uri)
-        elif uri in list(self.__store.keys()):
-            self.__store.pop(uri)
+        self.__leases.pop(uri, None)
+        self.__remove_from_snapshot(uri)
+        if uri in self.__local_cache:
+            self.__local_cache.pop(uri, None)
+        elif uri in self.__store:
+            self.__store.pop(uri, None)
         else:
             pass
             self.logger.debug('Store', "REMOVE KEY {0} NOT PRESENT".format(uri))
@@ -310,10 +523,12 @@ class Store(AbstractStore):
             self.logger.debug('Store', 'No writing right for URI {0}'.format(type(uri)))
             return None
 
-        if uri in list(self.__local_cache.keys()):
-            self.__local_cache.pop(uri)
-        elif uri in list(self.__store.keys()):
-            self.__store.pop(uri)
+        self.__leases.pop(uri, None)
+        self.__remove_from_snapshot(uri)
+        if uri in self.__local_cache:
+            self.__local_cache.pop(uri, None)
+        elif uri in self.__store:
+            self.__store.pop(uri, None)
         else:
             pass
             self.logger.debug('Store', "REMOVE KEY {0} NOT PRESENT".format(uri))
@@ -337,12 +552,18 @@ class Store(AbstractStore):
             else:
                 return self.resolve(uri)
 
+        self.__m_gets.inc()
         v = self.get_value(uri)
-        if v is None:
+        if v is None or not self.is_fresh(uri):
+            self.__m_misses.inc()
             self.__controller.onMiss()
             self.logger.debug('DStore', 'Resolving: {0}'.format(uri))
-            return self.resolve(uri)
+            rv = self.__resolve(uri)
+            if rv[1] is None and v is not None:
+                return v[0]
+            return rv[0]
         else:
+            self.__m_hits.inc()
             return v[0]
         # v = self.get_value(uri)
         # if v == None:
@@ -360,6 +581,79 @@ class Store(AbstractStore):
         #     return v[0]
 
 
+    def get_with_version(self, uri, consistency=CACHED_IF_NEWER_THAN, min_version=None):
+        '''
+
+        Retrive a single value and its version with the given consistency level:
+
+        - Store.LOCAL: only the values held by this store are considered, no remote resolution takes place
+        - Store.CACHED_IF_NEWER_THAN: the value held by this store is returned if its version is at least
+          min_version (any version if min_version is None), otherwise the value is resolved from remote stores
+        - Store.QUORUM: the value is resolved from a majority of the known stores, the most recent version wins
+
+        :param uri: key to retrieve
+        :param consistency: the consistency level
+        :param min_version: the minimum acceptable version for Store.CACHED_IF_NEWER_THAN
+        :return: the tuple (value, version), (None, None) if the value was not found
+        '''
+        if self.__is_metaresource(uri):
+            return (self.get(uri), 0)
+
+        self.__m_gets.inc()
+        v = self.get_value(uri)
+        if consistency == Store.LOCAL:
+            if v is None:
+                return (None, None)
+            self.__m_hits.inc()
+            return v
+
+        if consistency == Store.QUORUM:
+            self.__m_misses.inc()
+            quorum = (len(self.discovered_stores) + 1) // 2 + 1
+            rv = self.__resolve(uri, quorum - 1)
+        elif v is not None and self.is_fresh(uri) and (min_version is None or v[1] >= min_version):
+            self.__m_hits.inc()
+            return v
+        else:
+            self.__m_misses.inc()
+            self.__controller.onMiss()
+            rv = self.__resolve(uri)
+
+        if v is not None and (rv[1] is None or v[1] >= rv[1]):
+            return v
+        return rv
+
+    def mget(self, uris, consistency=CACHED_IF_NEWER_THAN, min_version=None):
+        '''
+
+        Same as get_with_version for many keys, the keys held fresh by this store are answered
+        directly while the misses are resolved concurrently, thus a batch costs about the time of
+        one resolution instead of one per miss.
+
+        :param uris: the keys to retrieve
+        :param consistency: the consistency level, see get_with_version
+        :param min_version: the minimum acceptable version for Store.CACHED_IF_NEWER_THAN
+        :return: the list of (value, version), in the order of the keys
+        '''
+        rs = [None] * len(uris)
+        misses = []
+        for (i, uri) in enumerate(uris):
+            v = self.get_value(uri)
+            if self.__is_metaresource(uri) or consistency == Store.LOCAL or \
+                    (consistency == Store.CACHED_IF_NEWER_THAN and v is not None and self.is_fresh(uri)
+                     and (min_version is None or v[1] >= min_version)):
+                rs[i] = self.get_with_version(uri, consistency, min_version)
+            else:
+                misses.append(i)
+        if len(misses) == 1:
+            rs[misses[0]] = self.get_with_version(uris[misses[0]], consistency, min_version)
+        elif len(misses) > 1:
+            with ThreadPoolExecutor(max_workers=min(len(misses), self.MGET_WORKERS)) as executor:
+                fs = [(i, executor.submit(self.get_with_version, uris[i], consistency, min_version)) for i in misses]
+                for (i, f) in fs:
+                    rs[i] = f.result()
+        return rs
+
     def resolve(self, uri):
         '''
 
@@ -368,7 +662,17 @@ class Store(AbstractStore):
         :param uri: the key to resolve
         :return: the value
         '''
-        rv = self.__controller.resolve(uri)
+        return self.__resolve(uri)[0]
+
+    def __resolve(self, uri, min_answers=None):
+        if self.is_cached_value(uri) and not self.__is_metaresource(uri):
+            # the resolved value is cached, thus its updates have to be received: with sharding
+            # the shard of the key may not be subscribed yet. The subscription is opened before
+            # resolving so that no update is missed in between.
+            self.__controller.subscribe(uri)
+        t = time.time()
+        rv = self.__controller.resolve(uri, min_answers=min_answers)
+        self.__m_resolve.observe(time.time() - t)
         # #print('Store', 'Resolve {} {}'.format(uri, rv))
         if rv != (None, -1):
             self.logger.debug('Store', 'URI: {0} was resolved to val = {1} and ver = {2}'.format(uri, rv[0], rv[1]))
@@ -377,20 +681,24 @@ class Store(AbstractStore):
             if not self.__is_metaresource(uri):
                 self.update_value(uri, rv[0], rv[1])
             self.notify_observers(uri, rv[0], rv[1])
-            return rv[0]
+            return rv
         else:
-            return None
+            return (None, None)
 
 
-    def getAll(self, uri):
+    def getAll(self, uri, where=None, select=None):
         '''
 
         Same as get but key can containt wildcards, this will not cause a resolve in case of cache miss
 
+        The values can be filtered by a predicate on their JSON fields and projected on some of
+        their fields, the fields being dot paths as in the fragments of dput, see dstore.query.
+
         :param uri: the uri of resources
+        :param where: if given, the predicate the values have to match, eg. status=run&entity_data.memory=2GB
+        :param select: if given, the fields to keep in the values, eg. status,entity_data.memory
         :return: a list of (key, value, version)
         '''
-        xs = []
         u = uri.split('/')[-1]
         if u.endswith('~') and u.startswith('~'):
             if u in self.__metaresources.keys():
@@ -398,28 +706,87 @@ class Store(AbstractStore):
             else:
                 return None
 
-        for k, v in self.__store.items():
-            if fnmatch.fnmatch(k, uri):
-                xs.append((k, v[0], v[1]))
-        for k, v in self.__local_cache.items():
-            if fnmatch.fnmatch(k, uri):
-                xs.append((k, v[0], v[1]))
-
+        xs = Query(where, select).apply(self.iterAll(uri))
         self.logger.debug('Store', '>>>>>> getAll({0}) = {1}'.format(uri, xs))
         return xs
 
-    def resolveAll(self, uri):
+    def iterAll(self, uri):
         '''
 
-        Same as getAll but always resolve
+        Same as getAll but lazily iterates over the matching entries, the values are retrieved
+        as the iteration proceeds. Only the keys sharing the literal prefix of the uri, the part
+        before its first wildcard, are scanned.
 
         :param uri: the uri of resources
+        :return: an iterator of (key, value, version)
+        '''
+        prefix = literal_prefix(uri)
+        for table in [self.__store, self.__local_cache]:
+            for k in table.scan(prefix):
+                if fnmatch.fnmatch(k, uri):
+                    v = table.get(k)
+                    if v is not None:
+                        yield (k, v[0], v[1])
+        sn = self.__snapshot
+        if sn is not None:
+            for (k, va, ve) in sn.items(uri):
+                if k not in self.__store and k not in self.__local_cache and k not in self.__snapshot_removed:
+                    yield (k, va, ve)
+
+    def scan(self, prefix='', start_after=None, limit=None):
+        '''
+
+        Iterates in key order over the entries held by this store, under home and cached, whose key
+        starts with the given prefix. Large namespaces can be paged through by giving the last key
+        of a page as start_after of the next one, each page costs O(log n + limit).
+
+        :param prefix: the prefix of the keys
+        :param start_after: if given, only the keys greater than it are returned
+        :param limit: if given, the maximum number of entries returned
+        :return: a list of (key, value, version)
+        '''
+        xs = []
+        if limit is not None and limit <= 0:
+            return xs
+        for k in self.__scan_keys(prefix, start_after, True):
+            v = self.get_value(k)
+            if v is not None:
+                xs.append((k, v[0], v[1]))
+                if limit is not None and len(xs) >= limit:
+                    break
+        return xs
+
+    def __scan_keys(self, prefix, start_after, cached):
+        ks = [self.__store.scan(prefix, start_after)]
+        if cached:
+            ks.append(self.__local_cache.scan(prefix, start_after))
+        sn = self.__snapshot
+        if sn is not None:
+            ks.append(k for k in sn.keys(prefix, start_after)
+                      if k not in self.__snapshot_removed and (cached or self.is_stored_value(k)))
+        last = None
+        for k in heapq.merge(*ks):
+            if k != last:
+                yield k
+            last = k
+
+    def resolveAll(self, uri, where=None, select=None):
+        '''
+
+        Same as getAll but always resolve, the predicate and the projection are evaluated by
+        the stores answering, thus only the matching entries and the selected fields are sent.
+
+        :param uri: the uri of resources
+        :param where: if given, the predicate the values have to match
+        :param select: if given, the fields to keep in the values
         :return: a list of (key, value, version)
         '''
-        xs = self.__controller.resolveAll(uri)
+        t = time.time()
+        xs = self.__controller.resolveAll(uri, where=where, select=select)
+        self.__m_resolve_all.observe(time.time() - t)
         # #print('Store', 'Resolve All {} {}'.format(uri, xs))
         self.logger.debug('Store', ' Resolved resolveAll = {0}'.format(xs))
-        ys = self.getAll(uri)
+        ys = self.getAll(uri, where, select)
 
         xs_dict = {k: (k, va, ve) for (k, va, ve) in xs}
         # xy_dict = {k: (k, va, ve) for (k, va, ve) in ys}
@@ -433,6 +800,28 @@ class Store(AbstractStore):
 
         return list(xs_dict.values())
 
+    def iterResolveAll(self, uri, where=None, select=None):
+        '''
+
+        Same as resolveAll but lazily iterates over the entries, those held by this store first,
+        then those of each store as its answer arrives, thus the result is never built as a whole.
+        Only the versions of the keys already returned are kept: a key is returned again when a
+        store answers a newer version of it, the last occurrence of a key being the newest.
+
+        :param uri: the uri of resources
+        :param where: if given, the predicate the values have to match
+        :param select: if given, the fields to keep in the values
+        :return: an iterator of (key, value, version)
+        '''
+        versions = {}
+        for (k, va, ve) in Query(where, select).filter(self.iterAll(uri)):
+            versions[k] = ve
+            yield (k, va, ve)
+        for (k, va, ve) in self.__controller.iterResolveAll(uri, where=where, select=select):
+            if k not in versions or ve > versions[k]:
+                versions[k] = ve
+                yield (k, va, ve)
+
     def miss_handler(self, action):
         pass
 
@@ -491,10 +880,25 @@ class Store(AbstractStore):
         return base
 
     def on_store_discovered(self, sid):
-        raise NotImplemented
+        with self.__discovery:
+            self.__discovery.notify_all()
 
     def on_store_disappeared(self, sid):
-        raise NotImplemented
+        with self.__discovery:
+            self.__discovery.notify_all()
+
+    def wait_ready(self, timeout=None, min_peers=0):
+        '''
+
+        Waits until this store has discovered at least min_peers other stores. The store is usable
+        as soon as it is created, yet resolutions only reach the stores discovered so far.
+
+        :param timeout: the maximum time to wait in seconds, None to wait forever
+        :param min_peers: the number of stores to discover
+        :return: True if the stores were discovered, False if the timeout expired
+        '''
+        with self.__discovery:
+            return self.__discovery.wait_for(lambda: len(self.discovered_stores) >= min_peers, timeout)
 
     def register_metaresource(self, resource, action):
         '''
@@ -530,27 +934,30 @@ class Store(AbstractStore):
 
     def __get_stores(self, uri):
         self.logger.debug('__get_stores', 'uri {}'.format(uri))
-        return self.discovered_stores
+        xs = self.__controller.membership.status()
+        for (sid, r) in self.__controller.rtt.status().items():
+            if sid in xs:
+                xs[sid].update(r)
+        return xs
 
-    def __get_keys_under(self, uri):
-        keys = self.keys()
-        ks = []
+    def __get_metrics(self, uri):
+        return self.metrics.snapshot()
+
+    def __get_profile(self, uri):
+        return self.__controller.profile()
 
+    def __get_aggregates(self, uri):
+        return {name: a.status() for (name, a) in list(self.__aggregates.items())}
+
+    def __get_keys_under(self, uri):
         if isinstance(uri, list):
             uri = uri[0]
 
         if '*' in uri:
             uri = uri + '*'
-            for k in keys:
-                self.logger.debug('__get_keys_under', '{} match {}? {}'.format(k, uri, fnmatch.fnmatch(k, uri)))
-                if fnmatch.fnmatch(k, uri):
-                    ks.append(k)
+            return [k for k in self.__scan_keys(literal_prefix(uri), None, False) if fnmatch.fnmatch(k, uri)]
         else:
-            for k in keys:
-                self.logger.debug('__get_keys_under', '{} starts with {}? {}'.format(k, uri, k.startswith(uri)))
-                if k.startswith(uri):
-                    ks.append(k)
-        return ks
+            return list(self.__scan_keys(uri, None, False))
 
     def __check_writing_rights(self, uri):
         # TODO add system_id to store values
@@ -564,5 +971,90 @@ class Store(AbstractStore):
         #     return False
         return True
 
+    def materialize(self, pattern, reducer, name=None, where=None):
+        '''
+
+        Maintains an aggregate of the values of the keys matching a pattern, e.g. the number of
+        nodes per status. The aggregate is computed once from the resolution of the pattern, then
+        updated with the changes notified to the observers of this store, local or remote, thus it
+        can be read without transferring the values again.
+
+        The aggregate is readable as the metaresource ~name~ under the home of this store, and
+        all the aggregates as ~aggregates~.
+
+        :param pattern: the pattern of the keys, can contain wildcards
+        :param reducer: a reducer of dstore.aggregate or one of count, group:path, sum:path, min:path, max:path,
+            the paths being dot paths as in the fragments of dput
+        :param name: the name of the aggregate, by default aggregateN
+        :param where: if given, the predicate the values have to match, see dstore.query
+        :return: the Aggregate, whose value method gives the current result
+        :raises ValueError: if the name is the one of another metaresource, e.g. keys or stores
+        '''
+        if name is None:
+            name = 'aggregate{}'.format(len(self.__aggregates))
+        if '~{}~'.format(name) in self.__metaresources and name not in self.__aggregates:
+            raise ValueError('The name {} is the one of a metaresource'.format(name))
+        if name in self.__aggregates:
+            self.dematerialize(name)
+        a = Aggregate(name, pattern, reducer, where)
+        # the observer is registered first so that no change is missed, the resolution
+        # does not override the newer versions it delivers
+        self.observe(pattern, a.update)
+        self.__aggregates[name] = a
+        self.register_metaresource(name, lambda uri: a.value())
+        for (k, va, ve) in self.resolveAll(pattern):
+            a.update(k, va, ve)
+        return a
+
+    def dematerialize(self, name):
+        '''
+
+        Stops maintaining an aggregate created by materialize
+
+        :param name: the name of the aggregate
+        :return: None
+        '''
+        a = self.__aggregates.pop(name, None)
+        if a is not None:
+            self.unobserve(a.pattern, a.update)
+            self.__metaresources.pop('~{}~'.format(name), None)
+
+    def snapshot(self, path):
+        '''
+
+        Writes the entries held by this store, under home and cached, to a snapshot file that can be
+        loaded with load_snapshot. The file is replaced atomically.
+
+        :param path: the file
+        :return: the number of entries written
+        '''
+        return write_snapshot(path, self.iterAll('*'))
+
+    def load_snapshot(self, path):
+        '''
+
+        Serves the entries of a snapshot file, the file is mapped in memory and the entries are read
+        from it on access until they are written or removed. The snapshot replaces the one previously
+        loaded, if any, the entries already held by the store take precedence over the snapshot.
+
+        :param path: the file written by snapshot
+        :return: the Snapshot, whose view method gives access to the values without copying them
+        '''
+        sn = Snapshot(path)
+        old = self.__snapshot
+        self.__snapshot_removed = set()
+        self.__snapshot = sn
+        if old is not None:
+            old.close()
+        return sn
+
+    def __remove_from_snapshot(self, uri):
+        sn = self.__snapshot
+        if sn is not None and sn.find(uri) is not None:
+            self.__snapshot_removed.add(uri)
+
     def close(self):
         self.__controller.stop()
+        self.tracer.close()
+        if self.__snapshot is not None:
+            self.__snapshot.close()
@@ -0,0 +1,220 @@
+import array
+import bisect
+import heapq
+import sys
+import threading
+from .index import KeyIndex
+
+
+class Bucket(object):
+    """The entries of a table sharing the same parent URI"""
+
+    __slots__ = ['index', 'leaves', 'values', 'versions', 'sorted']
+
+    def __init__(self):
+        self.index = {}  # leaf -> slot
+        self.leaves = []
+        self.values = []
+        self.versions = array.array('q')
+        self.sorted = []  # the leaves in order, for scan
+
+    def add(self, leaf, value, version):
+        self.index[leaf] = len(self.leaves)
+        self.leaves.append(leaf)
+        self.values.append(value)
+        self.versions.append(version)
+        bisect.insort(self.sorted, leaf)
+
+    def remove(self, slot):
+        # the last entry takes the place of the removed one
+        last = len(self.leaves) - 1
+        leaf = self.leaves[slot]
+        if slot != last:
+            moved = self.leaves[last]
+            self.leaves[slot] = moved
+            self.values[slot] = self.values[last]
+            self.versions[slot] = self.versions[last]
+            self.index[moved] = slot
+        self.leaves.pop()
+        self.values.pop()
+        self.versions.pop()
+        del self.index[leaf]
+        del self.sorted[bisect.bisect_left(self.sorted, leaf)]
+
+
+class CompactTable(object):
+    """A table of (value, version) entries keyed by URI, using less memory than a dictionary of tuples.
+
+    The URIs are split at their last '/': the parents are shared by the entries of the same
+    bucket and the leaves are interned, thus the URIs sharing long prefixes are not stored
+    in full. The values of a bucket are kept in a list and the versions in an array of 64 bit
+    integers, no tuple is allocated per entry.
+
+    The table has the subset of the dictionary interface used by Store, the (value, version)
+    tuples are built on access. As an entry spans several containers, the accesses are serialized
+    by a lock.
+
+    The keys can be scanned in order: the parents are kept in a KeyIndex and the leaves of each
+    bucket in a sorted list, both referring to the interned strings, thus no full URI is stored.
+    """
+
+    SCAN_CHUNK = 256
+
+    def __init__(self):
+        self.__buckets = {}
+        self.__parents = KeyIndex()
+        self.__len = 0
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def __split(uri):
+        i = uri.rfind('/') + 1
+        return uri[:i], uri[i:]
+
+    def __contains__(self, uri):
+        (p, l) = self.__split(uri)
+        b = self.__buckets.get(p)
+        return b is not None and l in b.index
+
+    def __len__(self):
+        return self.__len
+
+    def __getitem__(self, uri):
+        v = self.get(uri)
+        if v is None:
+            raise KeyError(uri)
+        return v
+
+    def __setitem__(self, uri, entry):
+        (value, version) = entry
+        (p, l) = self.__split(uri)
+        with self.__lock:
+            b = self.__buckets.get(p)
+            if b is None:
+                b = Bucket()
+                p = sys.intern(p)
+                self.__buckets[p] = b
+                self.__parents.add(p)
+            slot = b.index.get(l)
+            if slot is None:
+                b.add(sys.intern(l), value, version)
+                self.__len += 1
+            else:
+                b.values[slot] = value
+                b.versions[slot] = version
+
+    def __delitem__(self, uri):
+        if self.pop(uri, None) is None:
+            raise KeyError(uri)
+
+    def __iter__(self):
+        return self.keys()
+
+    def get(self, uri, default=None):
+        (p, l) = self.__split(uri)
+        with self.__lock:
+            b = self.__buckets.get(p)
+            if b is None:
+                return default
+            slot = b.index.get(l)
+            if slot is None:
+                return default
+            return (b.values[slot], b.versions[slot])
+
+    def pop(self, uri, default=None):
+        (p, l) = self.__split(uri)
+        with self.__lock:
+            b = self.__buckets.get(p)
+            if b is None:
+                return default
+            slot = b.index.get(l)
+            if slot is None:
+                return default
+            v = (b.values[slot], b.versions[slot])
+            b.remove(slot)
+            if len(b.leaves) == 0:
+                del self.__buckets[p]
+                self.__parents.remove(p)
+            self.__len -= 1
+            return v
+
+    def __scan_bucket(self, p, prefix, start_after):
+        # the keys of a bucket, in order, greater than start_after if given and starting with prefix
+        rest = prefix[len(p):]
+        last = None if start_after is None or not start_after.startswith(p) else start_after[len(p):]
+        if last is not None and last < rest:
+            last = None
+        while True:
+            with self.__lock:
+                b = self.__buckets.get(p)
+                if b is None:
+                    return
+                if last is None:
+                    j = bisect.bisect_left(b.sorted, rest)
+                else:
+                    j = bisect.bisect_right(b.sorted, last)
+                ls = b.sorted[j:j + self.SCAN_CHUNK]
+            for l in ls:
+                if not l.startswith(rest):
+                    return
+                yield p + l
+            if len(ls) < self.SCAN_CHUNK:
+                return
+            last = ls[-1]
+
+    def scan(self, prefix='', start_after=None):
+        """
+        :param prefix: only the keys starting with it are returned
+        :param start_after: if given, only the keys greater than it are returned
+        :return: an iterator of the keys in order
+        """
+        low = prefix
+        if start_after is not None and start_after > prefix:
+            low = start_after
+        # The keys greater than low are either in the buckets whose parent is a prefix of low,
+        # or in the ones whose parent is greater than low. As the keys of a bucket are greater
+        # than its parent, the buckets are merged as the merge reaches their parent.
+        ancestors = [''] + [low[:i + 1] for i in range(len(low)) if low[i] == '/']
+        heap = []
+        for p in ancestors:
+            if prefix.startswith(p) or p.startswith(prefix):
+                self.__push(heap, self.__scan_bucket(p, prefix, start_after))
+        parents = self.__parents.scan(prefix, low)
+        p = next(parents, None)
+        while True:
+            while p is not None and (len(heap) == 0 or p < heap[0][0]):
+                self.__push(heap, self.__scan_bucket(p, prefix, start_after))
+                p = next(parents, None)
+            if len(heap) == 0:
+                return
+            (k, i, it) = heapq.heappop(heap)
+            yield k
+            self.__push(heap, it, i)
+
+    @staticmethod
+    def __push(heap, it, i=None):
+        k = next(it, None)
+        if k is not None:
+            heapq.heappush(heap, (k, id(it) if i is None else i, it))
+
+    def keys(self):
+        with self.__lock:
+            bs = list(self.__buckets.items())
+        for (p, b) in bs:
+            with self.__lock:
+                ls = list(b.leaves)
+            for l in ls:
+                yield p + l
+
+    def items(self):
+        with self.__lock:
+            bs = list(self.__buckets.items())
+        for (p, b) in bs:
+            with self.__lock:
+                xs = [(p + l, (v, ve)) for (l, v, ve) in zip(b.leaves, b.values, b.versions)]
+            for x in xs:
+                yield x
+
+    def values(self):
+        for (k, v) in self.items():
+            yield v
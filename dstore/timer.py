@@ -0,0 +1,79 @@
+import heapq
+import itertools
+import threading
+import time
+from .logger import DLogger
+
+
+class TimerService(object):
+    """Runs the delayed and periodic actions of all the stores of a process on a single thread.
+
+    Actions are kept in a heap ordered by deadline, they must be short as they are executed
+    one after the other by the timer thread.
+    """
+
+    def __init__(self):
+        self.__heap = []
+        self.__seq = itertools.count()
+        self.__pending = set()
+        self.__cancelled = set()
+        self.logger = DLogger()
+        self.__cv = threading.Condition()
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def schedule(self, delay, action, args=[], period=None):
+        """Schedules an action
+
+        :param delay: the delay in seconds before the first execution
+        :param action: the function to execute
+        :param args: the arguments of the function
+        :param period: if not None the action is executed every *period* seconds
+        :return: a handle that can be given to cancel
+        """
+        h = next(self.__seq)
+        with self.__cv:
+            heapq.heappush(self.__heap, (time.time() + delay, h, action, args, period))
+            self.__pending.add(h)
+            self.__cv.notify()
+        return h
+
+    def cancel(self, handle):
+        """Cancels a scheduled action
+
+        :param handle: the handle returned by schedule, the actions already executed and None are ignored
+        """
+        with self.__cv:
+            if handle in self.__pending:
+                self.__cancelled.add(handle)
+
+    def stop(self):
+        with self.__cv:
+            self.__running = False
+            self.__cv.notify()
+
+    def __run(self):
+        while True:
+            with self.__cv:
+                while self.__running and (len(self.__heap) == 0 or self.__heap[0][0] > time.time()):
+                    if len(self.__heap) == 0:
+                        self.__cv.wait()
+                    else:
+                        self.__cv.wait(self.__heap[0][0] - time.time())
+                if not self.__running:
+                    return
+                (t, h, action, args, period) = heapq.heappop(self.__heap)
+                if h in self.__cancelled:
+                    self.__cancelled.discard(h)
+                    self.__pending.discard(h)
+                    continue
+                if period is not None:
+                    heapq.heappush(self.__heap, (t + period, h, action, args, period))
+                else:
+                    self.__pending.discard(h)
+            try:
+                action(*args)
+            except Exception as e:
+                self.logger.error('Timer', 'Action {} failed: {}'.format(action, e))
@@ -0,0 +1,156 @@
+import json
+import random
+import threading
+import time
+
+
+class TraceContext(object):
+    """The trace context of an update, carried by KeyValue from the origin store to the others"""
+
+    __slots__ = ['trace_id', 'origin_ts', 'origin_sid']
+
+    def __init__(self, trace_id, origin_ts, origin_sid):
+        self.trace_id = trace_id
+        self.origin_ts = origin_ts
+        self.origin_sid = origin_sid
+
+
+class Tracer(object):
+    """Follows the updates from the put on the origin store to the observers of the other stores.
+
+    The origin store starts a trace for a sample of its updates, the trace id and the origin
+    timestamp travel with the KeyValue and every stage an update goes through on a store
+    emits an event:
+
+    - put: the update is issued on the origin store
+    - publish: the update is written on DDS by the origin store
+    - receive: the update is received by a store
+    - update: the update is applied to the table of a store
+    - notify: the observers of a store have been notified
+
+    The delay from the origin is recorded in the histogram *propagation_seconds* for each
+    remote stage. The stores' clocks are assumed synchronized, e.g. with NTP, as the delay is
+    computed with the timestamp of the origin store.
+
+    Events are given to the hooks registered with add_hook, the span exporter is one of them.
+    """
+
+    STAGES = ['put', 'publish', 'receive', 'update', 'notify']
+
+    def __init__(self, store_id, metrics, sample_rate=0.0):
+        """
+        :param store_id: the id of the store
+        :param metrics: the metrics of the store
+        :param sample_rate: the fraction of the updates of this store that are traced
+        """
+        self.store_id = store_id
+        self.sample_rate = sample_rate
+        self.hooks = []
+        self.__local = threading.local()
+        self.__exporter = None
+        self.__latency = dict((s, metrics.histogram('propagation_seconds', 'Delay between the put on the origin store and each stage',
+                                                    stage=s)) for s in ['receive', 'update', 'notify'])
+
+    def add_hook(self, hook):
+        """Registers a function called with each event, as a dictionary with keys trace_id, stage,
+        uri, version, sid, origin_sid, origin_ts, ts and delay.
+
+        Hooks are called from the thread processing the update and must be fast.
+        """
+        self.hooks = self.hooks + [hook]
+
+    def remove_hook(self, hook):
+        self.hooks = [h for h in self.hooks if h != hook]
+
+    def export_spans(self, path):
+        """Appends the events to a file, one JSON object per line
+
+        :param path: the file, None stops the export
+        """
+        if self.__exporter is not None:
+            self.remove_hook(self.__exporter)
+            self.__exporter.close()
+            self.__exporter = None
+        if path is not None:
+            self.__exporter = SpanExporter(path)
+            self.add_hook(self.__exporter)
+
+    def start(self):
+        """
+        :return: the context of a new trace started on this store, None if the update is not sampled
+        """
+        if self.sample_rate <= 0 or (self.sample_rate < 1 and random.random() >= self.sample_rate):
+            return None
+        return TraceContext('{:016x}'.format(random.getrandbits(64)), time.time(), self.store_id)
+
+    def current(self):
+        """
+        :return: the context of the update being processed by this thread, None if it is not traced
+        """
+        return getattr(self.__local, 'ctx', None)
+
+    def activate(self, ctx):
+        """
+        :return: a context manager making ctx the current context of this thread
+        """
+        return ActiveTrace(self.__local, ctx)
+
+    def event(self, stage, uri, version=None):
+        """Emits an event of the current trace, if any
+
+        :param stage: one of STAGES
+        :param uri: the key of the update
+        :param version: the version of the update
+        """
+        ctx = getattr(self.__local, 'ctx', None)
+        if ctx is None:
+            return
+        t = time.time()
+        delay = t - ctx.origin_ts
+        if ctx.origin_sid != self.store_id and stage in self.__latency:
+            self.__latency[stage].observe(delay)
+        hooks = self.hooks
+        if len(hooks) > 0:
+            e = {'trace_id': ctx.trace_id, 'stage': stage, 'uri': uri, 'version': version, 'sid': self.store_id,
+                 'origin_sid': ctx.origin_sid, 'origin_ts': ctx.origin_ts, 'ts': t, 'delay': delay}
+            for h in hooks:
+                h(e)
+
+    def close(self):
+        self.export_spans(None)
+
+
+class ActiveTrace(object):
+    def __init__(self, local, ctx):
+        self.local = local
+        self.ctx = ctx
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = getattr(self.local, 'ctx', None)
+        self.local.ctx = self.ctx
+        return self.ctx
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.local.ctx = self.previous
+        return False
+
+
+class SpanExporter(object):
+    """Writes the trace events to a JSON lines file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.f = open(path, 'a', buffering=1)
+
+    def __call__(self, e):
+        line = json.dumps(e)
+        with self.lock:
+            if self.f is not None:
+                self.f.write(line + '\n')
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+            self.f = None
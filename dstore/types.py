@@ -1,30 +1,34 @@
 from cdds import TopicType
 
 class KeyValue(TopicType):
-    def __init__(self, version, key, value, sid):
+    def __init__(self, version, key, value, sid, lease=0, trace_id=None, origin_ts=None):
         self.version = version
         self.key = key
         self.value = value
         self.sid = sid
+        self.lease = lease # seconds for which the home store guarantees to publish any change
+        self.trace_id = trace_id # set if the update is traced, see tracing.Tracer
+        self.origin_ts = origin_ts # time of the put on the origin store of a traced update
 
     def gen_key(self):
         return self.key
 
     def __str__(self):
-        return 'KeyValue(version = {0}, key = {1}, value = {2}, sid = {3})'.format(self.version, self.key, self.value, self.sid)
+        return 'KeyValue(version = {0}, key = {1}, value = {2}, sid = {3}, lease = {4})'.format(self.version, self.key, self.value, self.sid, self.lease)
 
 
 class StoreInfo(TopicType):
-    def __init__(self, sid, sroot, shome):
+    def __init__(self, sid, sroot, shome, interval=None):
         self.sid = sid
         self.sroot = sroot
         self.shome = shome
+        self.interval = interval # seconds until the next advertisement of this store
 
     def gen_key(self):
         return self.sid
 
     def __str__(self):
-        return 'StoreInfo(sid = {0}, root = {1}, home= {2})'.format(self.sid, self.sroot, self.shome)
+        return 'StoreInfo(sid = {0}, root = {1}, home= {2}, interval = {3})'.format(self.sid, self.sroot, self.shome, self.interval)
 
 
 class CacheMiss(TopicType):
@@ -39,29 +43,32 @@ class CacheMiss(TopicType):
         return 'CacheMiss(source_sid = {0}, key = {1})'.format(self.source_sid, self.key)
 
 class CacheHit(TopicType):
-    def __init__(self, source_sid, dest_sid, key, value, version):
+    def __init__(self, source_sid, dest_sid, key, value, version, lease=0):
         self.source_sid = source_sid
         self.dest_sid = dest_sid
         self.key = key
         self.value = value
         self.version = version
+        self.lease = lease
 
     def gen_key(self):
        return self.key
 
     def __str__(self):
-        return 'CacheHit(source_sid = {0}, dest_sid = {1}, key = {2}, value = {3}, version = {4})'.format(self.source_sid, self.dest_sid, self.key, self.value, self.version)
+        return 'CacheHit(source_sid = {0}, dest_sid = {1}, key = {2}, value = {3}, version = {4}, lease = {5})'.format(self.source_sid, self.dest_sid, self.key, self.value, self.version, self.lease)
 
 class CacheMissMV(TopicType):
-    def __init__(self, source_sid, key):
+    def __init__(self, source_sid, key, where=None, select=None):
         self.source_sid = source_sid
         self.key = key
+        self.where = where  # predicate and projection evaluated by the answering stores, see dstore.query
+        self.select = select
 
     def gen_key(self):
        return self.key
 
     def __str__(self):
-        return 'CacheMissMV(source_sid = {0}, key = {1})'.format(self.source_sid, self.key)
+        return 'CacheMissMV(source_sid = {0}, key = {1}, where = {2}, select = {3})'.format(self.source_sid, self.key, self.where, self.select)
 
 class CacheHitMV(TopicType):
     def __init__(self, source_sid, dest_sid, key, kvave):
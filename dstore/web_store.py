@@ -1,8 +1,15 @@
 import asyncio
 import websockets
 import logging
+import json
+import base64
+import collections
+import threading
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from .store import Store
+from .host import StoreHost
+from .codec import Value, jsonable
 
 
 
@@ -20,24 +27,161 @@ from .store import Store
 #    put     sid uri val                -> OK | NOK
 #    dput     sid uri [val]             -> OK | NOK
 #    get     sid uri                    -> value sid key value
-#    aget     sid uri                    -> values sid key key1@value1,key2@value2,...,keyn@valuen
+#    aget     sid uri [where [select]]   -> values sid key key1@value1,key2@value2,...,keyn@valuen
 #    resolve  sid uri                    -> value sid key value
-#    aresolve sid uri                    -> values sid key key1@value1,key2@value2,...,keyn@valuen
+#    aresolve sid uri [where [select]]   -> values sid key key1@value1,key2@value2,...,keyn@valuen
 #    remove  sid uri                    -> OK | NOK
+#    scan    sid prefix [limit [after]] -> values sid prefix key1@value1|key2@value2|...|keyn@valuen
 #
-#    observe sid uri cookie             -> stream notify sid cookie key value
+#    observe sid uri cookie [max-pending [coalesce]]  -> stream notify sid cookie key value
+#    ostats  sid cookie                 -> stats sid cookie sent dropped coalesced lag max-lag
+#
+# Notifications are buffered in a queue of at most max-pending (default 1024) entries, the
+# oldest entries are dropped when a client does not keep up. When coalesce is given only the
+# latest value of each key is queued.
+#
+# Any command can be prefixed by a request id of the form #rid, e.g.:
+#
+#    #42 get sid uri                    -> #42 value sid key value
+#
+# Commands carrying a request id are executed concurrently and their answer, prefixed
+# by the same #rid, is sent as soon as it is available, thus answers may be received
+# out of order. Commands without a request id are executed in order.
+#
+# The command
+#
+#    proto json                         -> OK proto json
+#
+# switches the connection to the framed protocol, in which every WebSocket message is a
+# JSON object. Requests have the format:
+#
+#    {"id": rid, "cmd": command, "sid": store-id, ...arguments}
+#
+# where the arguments are "key", "value", "keys" (mget), "entries" (mput, a list of
+# {"key": key, "value": value}), "root", "home", "size" (create), "consistency",
+# "min_version" (get, see Store.get_with_version), "cookie", "max_pending",
+# "coalesce" (observe, ostats), "limit", "start_after" (scan, "key" being the prefix) and
+# "where", "select" (aget, aresolve) and "codec" (put, mput, dput).
+#
+# With a codec, raw, json or msgpack, the value is stored as a typed value (see Store.put): the
+# values of the json and msgpack codecs are given as JSON, the raw ones base64 encoded. Typed
+# values are answered and notified in the same form.
+#
+# where is a predicate on the JSON fields of the values and select the fields to return,
+# e.g. status=run&entity_data.memory=2GB and status,entity_data.memory, see dstore.query.
+# Answers have the same structure as the ones of the RestStore plus the request id:
+#
+#    {"id": rid, "result": bool, "store_id": store-id, "data": [{"key": key, "value": value, "version": version}], "more": bool}
+#
+# The answer of scan also has "next", the start_after of the next page or null after the last page.
+# Large aget/aresolve results are streamed as several answers with the same request id,
+# all but the last one having "more" set to true. Notifications have the format:
+#
+#    {"cmd": "notify", "store_id": store-id, "cookie": cookie, "data": [{"key": key, "value": value, "version": version}]}
 
 
 class Dispatcher (object):
-    def __init__(self, cookie, wsock):
+    '''
+
+    Forwards the notifications of an observer to a WebSocket.
+
+    Notifications are buffered in a bounded queue drained by the event loop, when the queue
+    is full the oldest notification is dropped. When coalescing is enabled only the latest
+    value of each key is kept in the queue.
+
+    '''
+    def __init__(self, cookie, wsock, loop, max_pending=1024, coalesce=False):
         self.cookie = cookie
         self.wsock = wsock
-
+        self.loop = loop
+        self.observed = None  # the (store, uri) observed
+        self.max_pending = max(max_pending, 1)
+        self.coalesce = coalesce
+        if coalesce:
+            self.pending = collections.OrderedDict()
+        else:
+            self.pending = collections.deque()
+        self.lock = threading.Lock()
+        self.flushing = False
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_lag = 0
+
+    def encode(self, key, val, ver):
+        return '{} {} {}'.format(self.cookie, key, val)
 
     def dispatch(self, key, val, ver):
-        print("Dispatching observer")
-        result = '{} {} {}'.format(self.cookie, key, val)
-        asyncio.ensure_future(self.wsock.send(result))
+        # Observers are notified from the thread that changed the store, thus
+        # the notification is queued and the send is handed over to the event loop.
+        with self.lock:
+            if self.closed:
+                return
+            if self.coalesce and key in self.pending:
+                self.pending[key] = (key, val, ver)
+                self.coalesced += 1
+            else:
+                if len(self.pending) >= self.max_pending:
+                    self.__pop()
+                    self.dropped += 1
+                if self.coalesce:
+                    self.pending[key] = (key, val, ver)
+                else:
+                    self.pending.append((key, val, ver))
+            self.max_lag = max(self.max_lag, len(self.pending))
+            if self.flushing:
+                return
+            self.flushing = True
+        self.loop.call_soon_threadsafe(self.__start_flush)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.pending.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'sent': self.sent, 'dropped': self.dropped, 'coalesced': self.coalesced,
+                    'lag': len(self.pending), 'max_lag': self.max_lag, 'max_pending': self.max_pending}
+
+    def __pop(self):
+        if self.coalesce:
+            return self.pending.popitem(last=False)[1]
+        else:
+            return self.pending.popleft()
+
+    def __start_flush(self):
+        asyncio.ensure_future(self.flush())
+
+    @asyncio.coroutine
+    def flush(self):
+        while True:
+            with self.lock:
+                if len(self.pending) == 0:
+                    self.flushing = False
+                    return
+                n = self.__pop()
+            try:
+                yield from self.wsock.send(self.encode(*n))
+            except Exception:
+                with self.lock:
+                    self.closed = True
+                    self.flushing = False
+                    self.dropped += len(self.pending) + 1
+                    self.pending.clear()
+                return
+            self.sent += 1
+
+
+class FrameDispatcher (Dispatcher):
+    def __init__(self, sid, cookie, wsock, loop, max_pending=1024, coalesce=False):
+        super(FrameDispatcher, self).__init__(cookie, wsock, loop, max_pending, coalesce)
+        self.sid = sid
+
+    def encode(self, key, val, ver):
+        return json.dumps({'cmd': 'notify', 'store_id': self.sid, 'cookie': self.cookie,
+                           'data': [{'key': key, 'value': jsonable(val), 'version': ver}]})
 
 
 class WebStore (object):
@@ -64,21 +208,31 @@ class WebStore (object):
 
        get     sid uri                    -> value sid key value
 
-       aget     sid uri                    -> values sid key key1@value1,key2@value2,...,keyn@valuen
+       aget     sid uri [where [select]]   -> values sid key key1@value1,key2@value2,...,keyn@valuen
 
        resolve  sid uri                    -> value sid key value
 
-       aresolve sid uri                    -> values sid key key1@value1,key2@value2,...,keyn@valuen
+       aresolve sid uri [where [select]]   -> values sid key key1@value1,key2@value2,...,keyn@valuen
 
        remove  sid uri                    -> OK | NOK
+
+       scan    sid prefix [limit [after]] -> values sid prefix key1@value1|key2@value2|...|keyn@valuen
     
-       observe sid uri cookie             -> stream notify sid cookie key value
+       observe sid uri cookie [max-pending [coalesce]]  -> stream notify sid cookie key value
+
+       ostats  sid cookie                 -> stats sid cookie sent dropped coalesced lag max-lag
 
+    Any command can be prefixed by a request id of the form #rid, in which case the command
+    is executed concurrently with the others and the answer is prefixed by the same #rid:
 
+       #42 get sid uri                    -> #42 value sid key value
+
+    The command *proto json* switches the connection to the framed protocol, where requests and
+    answers are JSON objects, and which also supports the batch commands mget and mput.
 
 
     '''
-    def __init__(self, port, auth = None):
+    def __init__(self, port, auth = None, workers = None, max_inflight = 256, chunk_size = 512):
         '''
 
         Create the websocket server
@@ -86,44 +240,99 @@ class WebStore (object):
 
         :param port: port to listen
         :param auth: authorization string
+        :param workers: number of threads used to execute the store operations
+        :param max_inflight: maximum number of concurrent requests per connection
+        :param chunk_size: maximum number of entries per answer of the framed protocol
         '''
         self.port = port
         self.auth = auth
         self.svc = None
+        self.max_inflight = max_inflight
+        self.chunk_size = chunk_size
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.dispatchers = {}  # (websocket, sid, cookie) -> Dispatcher
 
         self.logger_impl = logging.getLogger('websockets')
         self.logger_impl.setLevel(logging.DEBUG)
         self.logger_impl.addHandler(logging.StreamHandler())
         # self.logger = DLogger()
         # self.logger.logger = self.logger_impl
-        self.storeMap = {}
+        self.host = StoreHost()
 
     @asyncio.coroutine
-    def process(self, websocket, cmd):
+    def process(self, websocket, cmd, inflight=None):
         if cmd is not None:
             xs = [x for x in cmd.split(' ') if x is not '']
+            rid = None
+            if len(xs) > 0 and xs[0].startswith('#'):
+                rid = xs[0][1:]
+                xs = xs[1:]
             if len(xs) < 2:
                 print(">> Received invalid command {}".format(str(cmd)))
             else:
                 cid = xs[0]
                 sid = xs[1]
                 args = xs[2:]
-                yield from self.handle_command(websocket, cid, sid, args)
+                if rid is None or inflight is None:
+                    yield from self.handle_command(websocket, cid, sid, args, rid)
+                else:
+                    # Stop reading from the connection while too many requests are pending
+                    yield from inflight.acquire()
+                    f = asyncio.ensure_future(self.handle_command(websocket, cid, sid, args, rid))
+                    f.add_done_callback(lambda _: inflight.release())
 
 
+    @asyncio.coroutine
+    def process_frame(self, websocket, frame, inflight=None):
+        try:
+            msg = json.loads(frame)
+        except ValueError:
+            msg = None
+        if not isinstance(msg, dict):
+            print(">> Received invalid frame {}".format(str(frame)))
+            yield from websocket.send(json.dumps({'id': None, 'result': False, 'store_id': None, 'data': None, 'more': False}))
+        elif msg.get('id') is None or inflight is None:
+            yield from self.handle_frame(websocket, msg)
+        else:
+            yield from inflight.acquire()
+            f = asyncio.ensure_future(self.handle_frame(websocket, msg))
+            f.add_done_callback(lambda _: inflight.release())
+
     def create(self, sid, args):
-        if len(args) < 3:
+        if len(args) < 3 or None in args:
             return None
         else:
-            return Store(sid, args[0], args[1], int(args[2]))
+            return self.host.create(sid, args[0], args[1], int(args[2]))
 
     def close(self, sid):
-        if sid in self.storeMap.keys():
-            store = self.storeMap.pop(sid)
-            store.close()
-
+        for (ws, s, cookie) in list(self.dispatchers.keys()):
+            if s == sid:
+                self.remove_dispatcher(ws, s, cookie)
+        self.host.close(sid)
         return True
 
+    def add_dispatcher(self, websocket, sid, cookie, disp, store, uri):
+        # a dispatcher registered by the connection with the same cookie is replaced
+        self.remove_dispatcher(websocket, sid, cookie)
+        disp.observed = (store, uri)
+        self.dispatchers[(websocket, sid, cookie)] = disp
+        store.observe(uri, disp.dispatch)
+
+    def remove_dispatcher(self, websocket, sid, cookie):
+        disp = self.dispatchers.pop((websocket, sid, cookie), None)
+        if disp is not None:
+            (store, uri) = disp.observed
+            store.unobserve(uri, disp.dispatch)
+            disp.close()
+
+    def forget_connection(self, websocket):
+        '''
+        Unregisters the observers of a closed connection
+        '''
+        for (ws, sid, cookie) in list(self.dispatchers.keys()):
+            if ws is websocket:
+                self.remove_dispatcher(ws, sid, cookie)
+
     def put(self, store, args):
         if len(args) < 2:
             return False
@@ -142,7 +351,7 @@ class WebStore (object):
     def getAll(self, store, args):
         xs = []
         if len(args) > 0:
-            vs = store.getAll(args[0])
+            vs = store.getAll(*args[:3])
             xs = []
             for (key, val, ver) in vs:
                 xs.append('{}@{}'.format(key, val))
@@ -160,13 +369,22 @@ class WebStore (object):
     def resolveAll(self, store, args):
         xs = []
         if len(args) > 0:
-            vs = store.resolveAll(args[0])
+            vs = store.resolveAll(*args[:3])
             xs = []
             for (key, val, ver) in vs:
                 xs.append('{}@{}'.format(key, val))
 
         return xs
 
+    def scan(self, store, args):
+        xs = []
+        if len(args) > 0:
+            limit = int(args[1]) if len(args) > 1 else None
+            start_after = args[2] if len(args) > 2 else None
+            for (key, val, ver) in store.scan(args[0], start_after, limit):
+                xs.append('{}@{}'.format(key, val))
+        return xs
+
     def remove(self, store, args):
         if len(args) > 0:
             store.remove(args[0])
@@ -186,14 +404,17 @@ class WebStore (object):
         return result
 
 
-    def observe(self, store, sid, args, websocket):
+    def observe(self, store, sid, args, websocket, loop):
         success = False
         print("len(args) {}".format(len(args)))
         if len(args) > 1:
             success = True
             cookie = 'notify {} {}'.format(sid, args[1])
-            disp = Dispatcher(cookie, websocket)
-            store.observe(args[0], disp.dispatch)
+            max_pending = 1024
+            if len(args) > 2:
+                max_pending = int(args[2])
+            disp = Dispatcher(cookie, websocket, loop, max_pending, len(args) > 3 and args[3] == 'coalesce')
+            self.add_dispatcher(websocket, sid, args[1], disp, store, args[0])
         else:
             print("Observe failed!")
         print("success = {}".format(success))
@@ -211,24 +432,37 @@ class WebStore (object):
 
 
     @asyncio.coroutine
-    def handle_command(self, websocket, cid, sid, args):
+    def handle_command(self, websocket, cid, sid, args, rid=None):
         # self.logger.debug("fog05ws", ">> Handling command {}".format(cid))
         # print(">> Handling command {}".format(cid))
 
+        # Store operations are blocking, thus they are executed on the thread pool
+        loop = asyncio.get_event_loop()
+        try:
+            answer = yield from loop.run_in_executor(self.executor, self.execute, websocket, loop, cid, sid, args)
+        except Exception as e:
+            # e.g. missing or malformed arguments, the command is answered anyway so that the
+            # client is not left waiting
+            print(">> Failed to execute command {}: {}".format(cid, e))
+            answer = 'NOK {}'.format(e)
+        if rid is not None:
+            answer = '#{} {}'.format(rid, answer)
+        yield from websocket.send(answer)
+        # if success:
+        #     yield from self.send_success(websocket, result)
+        # else:
+        #     yield from self.send_error(websocket, result)
+
+    def execute(self, websocket, loop, cid, sid, args):
         result = '{} {}'.format(cid,sid)
         prefix = 'NOK'
 
         # -- Create
         if cid == 'create':
-            if not (sid in self.storeMap.keys()):
-                s = self.create(sid, args)
-                if s is not None:
-                    self.storeMap[sid] = s
-                    prefix = 'OK'
-                else:
-                    prefix = 'NOK'
-            else:
+            if self.create(sid, args) is not None:
                 prefix = 'OK'
+            else:
+                prefix = 'NOK'
 
         elif cid == 'close':
             if self.close(sid):
@@ -237,9 +471,8 @@ class WebStore (object):
                 prefix = 'NOK'
 
         else:
-            store = None
-            if sid in self.storeMap.keys():
-                store = self.storeMap.get(sid)
+            store = self.host.get(sid)
+            if store is not None:
 
                 # -- Put
                 if cid == 'put':
@@ -282,6 +515,11 @@ class WebStore (object):
                     result = "{} {} {} {}".format('values', sid, args[0], '|'.join(vs))
                     prefix = ''
 
+                elif cid == 'scan':
+                    vs = self.scan(store, args)
+                    result = "{} {} {} {}".format('values', sid, args[0] if len(args) > 0 else '', '|'.join(vs))
+                    prefix = ''
+
                 # -- Keys
                 elif cid == 'gkeys':
                     ks = store.keys()
@@ -290,16 +528,144 @@ class WebStore (object):
 
                 # -- Observe
                 elif cid == 'observe':
-                    if self.observe(store, sid, args, websocket):
+                    if self.observe(store, sid, args, websocket, loop):
                         result = "{} {} {}".format(cid, args[0], args[1])
                         prefix = 'OK'
 
+                elif cid == 'ostats':
+                    if len(args) > 0 and (websocket, sid, args[0]) in self.dispatchers:
+                        st = self.dispatchers.get((websocket, sid, args[0])).stats()
+                        result = "{} {} {} {} {} {} {} {}".format('stats', sid, args[0], st['sent'], st['dropped'],
+                                                                  st['coalesced'], st['lag'], st['max_lag'])
+                        prefix = ''
 
-        yield from websocket.send('{} {}'.format(prefix, result))
-        # if success:
-        #     yield from self.send_success(websocket, result)
-        # else:
-        #     yield from self.send_error(websocket, result)
+        return '{} {}'.format(prefix, result)
+
+    @asyncio.coroutine
+    def handle_frame(self, websocket, msg):
+        loop = asyncio.get_event_loop()
+        try:
+            answers = yield from loop.run_in_executor(self.executor, self.execute_frame, websocket, loop, msg)
+        except Exception as e:
+            # e.g. a malformed request or a value that its codec cannot encode, the request
+            # is answered anyway so that the client is not left waiting
+            print(">> Failed to execute frame {}: {}".format(msg.get('cmd'), e))
+            answers = [json.dumps({'id': msg.get('id'), 'result': False, 'store_id': msg.get('sid'), 'data': None, 'more': False})]
+        for a in answers:
+            yield from websocket.send(a)
+
+    def frame_value(self, value, codec):
+        # typed values are given decoded, the raw ones base64 encoded, an invalid encoding
+        # raises binascii.Error and the request is answered with an error
+        if codec == 'raw' and isinstance(value, str):
+            return base64.b64decode(value, validate=True)
+        if codec is None and value is not None and not isinstance(value, str):
+            return json.dumps(value)
+        return value
+
+    def execute_frame(self, websocket, loop, msg):
+        cid = msg.get('cmd')
+        sid = msg.get('sid')
+        key = msg.get('key')
+        codec = msg.get('codec')
+        value = self.frame_value(msg.get('value'), codec)
+
+        result = False
+        data = None
+
+        if cid == 'create':
+            result = self.create(sid, [msg.get('root'), msg.get('home'), msg.get('size', 0)]) is not None
+
+        elif cid == 'close':
+            result = self.close(sid)
+
+        elif self.host.get(sid) is not None:
+            store = self.host.get(sid)
+
+            if cid == 'put' and key is not None:
+                data = [{'key': key, 'value': jsonable(value), 'version': store.put(key, value, codec)}]
+                result = True
+
+            elif cid == 'mput':
+                # the entries are all checked and encoded first, so that nothing is put when one is invalid
+                xs = []
+                for e in msg.get('entries', []):
+                    if not isinstance(e.get('key'), str):
+                        raise ValueError('invalid key {}'.format(e.get('key')))
+                    v = self.frame_value(e.get('value'), codec)
+                    xs.append((e.get('key'), Value.encode(codec, v) if codec is not None else v))
+                data = []
+                for (k, v) in xs:
+                    data.append({'key': k, 'value': jsonable(v), 'version': store.put(k, v)})
+                result = True
+
+            elif cid == 'dput' and key is not None:
+                data = [{'key': key, 'value': jsonable(value), 'version': store.dput(key, value, codec)}]
+                result = True
+
+            elif cid == 'remove' and key is not None:
+                store.remove(key)
+                data = [{'key': key, 'value': None, 'version': None}]
+                result = True
+
+            elif cid == 'get' and key is not None:
+                (v, ver) = store.get_with_version(key, msg.get('consistency', Store.CACHED_IF_NEWER_THAN), msg.get('min_version'))
+                data = [{'key': key, 'value': jsonable(v), 'version': ver}]
+                result = True
+
+            elif cid == 'resolve' and key is not None:
+                v = store.resolve(key)
+                data = [{'key': key, 'value': jsonable(v), 'version': store.get_version(key)}]
+                result = True
+
+            elif cid == 'mget':
+                # the misses are resolved concurrently, see Store.mget
+                ks = msg.get('keys', [])
+                vs = store.mget(ks, msg.get('consistency', Store.CACHED_IF_NEWER_THAN), msg.get('min_version'))
+                data = [{'key': k, 'value': jsonable(v), 'version': ver} for (k, (v, ver)) in zip(ks, vs)]
+                result = True
+
+            elif cid in ['aget', 'aresolve'] and key is not None:
+                if cid == 'aget':
+                    vs = store.getAll(key, msg.get('where'), msg.get('select'))
+                else:
+                    vs = store.resolveAll(key, msg.get('where'), msg.get('select'))
+                if vs is None:
+                    vs = []
+                xs = [{'key': k, 'value': jsonable(va), 'version': ve} for (k, va, ve) in vs]
+                # Large results are streamed over several frames
+                answers = []
+                for i in range(0, max(len(xs), 1), self.chunk_size):
+                    answers.append(json.dumps({'id': msg.get('id'), 'result': True, 'store_id': sid,
+                                               'data': xs[i:i + self.chunk_size],
+                                               'more': i + self.chunk_size < len(xs)}))
+                return answers
+
+            elif cid == 'scan':
+                limit = msg.get('limit', self.chunk_size)
+                vs = store.scan(key or '', msg.get('start_after'), limit)
+                data = [{'key': k, 'value': jsonable(va), 'version': ve} for (k, va, ve) in vs]
+                # a full page may be followed by others
+                nxt = vs[-1][0] if len(vs) > 0 and len(vs) == limit else None
+                return [json.dumps({'id': msg.get('id'), 'result': True, 'store_id': sid, 'data': data,
+                                    'more': False, 'next': nxt})]
+
+            elif cid == 'gkeys':
+                data = [{'key': k, 'value': None, 'version': None} for k in store.keys()]
+                result = True
+
+            elif cid == 'observe' and key is not None:
+                disp = FrameDispatcher(sid, msg.get('cookie'), websocket, loop,
+                                       msg.get('max_pending', 1024), msg.get('coalesce', False))
+                self.add_dispatcher(websocket, sid, msg.get('cookie'), disp, store, key)
+                result = True
+
+            elif cid == 'ostats' and (websocket, sid, msg.get('cookie')) in self.dispatchers:
+                st = self.dispatchers.get((websocket, sid, msg.get('cookie'))).stats()
+                data = [{'key': msg.get('cookie'), 'value': st, 'version': None}]
+                result = True
+
+        return [json.dumps({'id': msg.get('id'), 'result': result, 'store_id': sid, 'data': data, 'more': False})]
 
     def authenticate(self, client):
         if self.auth is None:
@@ -315,22 +681,30 @@ class WebStore (object):
                 raddr = websocket.remote_address
                 client_auth = path.split('/')[1]
                 if self.authenticate(client_auth):
+                    inflight = asyncio.Semaphore(self.max_inflight)
+                    framed = False
                     while True:
                         message = yield from websocket.recv()
-                        print(">> Processing message {}".format(message))
-                        yield from self.process(websocket, message)
+                        if framed:
+                            yield from self.process_frame(websocket, message, inflight)
+                        elif message.strip() == 'proto json':
+                            framed = True
+                            yield from websocket.send('OK proto json')
+                        else:
+                            yield from self.process(websocket, message, inflight)
 
                 else:
                     print(">> Closing connection because of invalid authentication.")
         except:
             print(">> Remote peer closed the connection, doing the same.")
             websocket.close()
+        finally:
+            self.forget_connection(websocket)
 
     def stop(self):
             try:
-                for id in list(self.storeMap.keys()):
-                    store = self.storeMap.pop(id)
-                    store.close()
+                self.host.close_all()
+                self.executor.shutdown(wait=False)
             except Exception as e:
                 print('Error on exiting {}'.format(e))
             finally:
@@ -2,6 +2,7 @@ from dstore import Store
 import uuid
 import random
 s = Store('b','afos://0','afos://0/b',1024)
+s.wait_ready(2, 1)
 
 while True:
     input('Press enter to put something in the store!')
@@ -1,5 +1,6 @@
 from dstore import Store
 s = Store('c','afos://0','afos://0/c',1024)
+s.wait_ready(2, 1)
 i = 0
 while True:
     input('Press enter to see discovered stores and do a resolve all on root')
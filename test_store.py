@@ -4,6 +4,7 @@ import sys
 if __name__ == '__main__':
     if len(sys.argv) > 1:
         s = Store(sys.argv[1], '/', '/home', 1024)
+        s.wait_ready(2, 1)
         k = input()
         v = input()
         s.put(k, v)